@@ -0,0 +1,102 @@
+"""Checks that slow provider calls from different users overlap instead of running one after another.
+
+N users each send one GPT message at the same moment while the fake OpenAI client takes --latency seconds
+per call. Updates go through the application's update queue, so the concurrent_updates setting is what is
+being measured. The run fails when all N replies take longer than --max-factor times a single call:
+
+    python -m benchmarks.concurrency_check --users 50 --latency 0.5
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from benchmarks.dispatch_benchmark import (
+    TOKEN,
+    FakeLatency,
+    FakeOpenAIClient,
+    FakeTelegramRequest,
+    synthetic_update,
+)
+from bot.telegram_bot import TelegramBot
+from clients.provider_registry import ProviderRegistry
+from utils.token_counter import HeuristicTokenCounter, SERVICE_TOKEN_BUDGETS, set_token_counter
+
+
+async def run(args, directory: str) -> float:
+    providers = ProviderRegistry()
+    providers.register("openai", "benchmarks.dispatch_benchmark", "FakeOpenAIClient")
+    providers.instances["openai"] = FakeOpenAIClient(FakeLatency(args.latency, 0, spread=0))
+    for service in SERVICE_TOKEN_BUDGETS:
+        set_token_counter(service, HeuristicTokenCounter())
+
+    telegram_bot = TelegramBot(providers, config={
+        "token": TOKEN,
+        "database_url": f"sqlite+aiosqlite:///{os.path.join(directory, 'concurrency.db')}",
+        # Without streaming every update answers with exactly two messages, a notice and the reply
+        "streaming_replies": False,
+        # Admission control is not under test here
+        "provider_limits": {"openai": {"max_concurrency": args.users}},
+    })
+    request = FakeTelegramRequest()
+    application = (
+        Application.builder()
+        .bot(Bot(TOKEN, request=request, get_updates_request=request))
+        .concurrent_updates(args.concurrent_updates)
+        .build()
+    )
+    telegram_bot.add_handlers(application)
+
+    users = range(1000, 1000 + args.users)
+    async with application:
+        await telegram_bot.post_init(application)
+        for user_id in users:
+            await telegram_bot.repository.insert_user(user_id, "load", "Load", "Test")
+            await telegram_bot.repository.set_user_state(user_id, "gpt")
+        request.calls.clear()
+
+        await application.start()
+        started = time.perf_counter()
+        for update_id, user_id in enumerate(users):
+            await application.update_queue.put(
+                Update.de_json(synthetic_update(update_id, user_id, "gpt"), application.bot)
+            )
+        while request.calls["sendMessage"] < 2 * args.users:
+            if time.perf_counter() - started > args.latency * args.users + 10:
+                raise TimeoutError(f"only {request.calls['sendMessage']} of {2 * args.users} messages were sent")
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        await application.stop()
+        await telegram_bot.post_shutdown(application)
+    return elapsed
+
+
+def main(args) -> int:
+    logging.getLogger().setLevel(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as directory:
+        elapsed = asyncio.run(run(args, directory))
+
+    print(f"users:               {args.users}")
+    print(f"provider latency:    {args.latency:.3f} s")
+    print(f"all replies sent in: {elapsed:.3f} s ({elapsed / args.latency:.1f}x one call, "
+          f"{args.users}x if run one after another)")
+    if elapsed > args.latency * args.max_factor:
+        print(f"FAILED: expected under {args.latency * args.max_factor:.3f} s")
+        return 1
+    print("ok: updates were processed concurrently")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds every fake OpenAI call takes")
+    parser.add_argument("--concurrent-updates", type=int, default=256)
+    parser.add_argument("--max-factor", type=float, default=3.0,
+                        help="allowed total time as a multiple of one call's latency")
+    raise SystemExit(main(parser.parse_args()))
@@ -0,0 +1,412 @@
+"""Feeds synthetic updates for every service through the real TelegramBot handlers and reports throughput.
+
+Providers are replaced by fake clients with configurable latency and error rate, and the Telegram Bot API by
+a fake request backend that records every call, so nothing touches the network:
+
+    python -m benchmarks.dispatch_benchmark --updates 3000 --concurrency 64 --latency 0.02 --error-rate 0.01
+
+A sample of chats per service is checked for the replies the handlers should have sent, and runs of a
+workload stored in benchmarks/baselines/dispatch.json are compared against it. Either kind of failure exits
+with status 1. The baseline file is only written with --update-baseline.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+from sqlalchemy import event
+from telegram import Bot, Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+from bot.telegram_bot import TelegramBot
+from clients.hedged_client import percentile
+from clients.provider_registry import ProviderRegistry
+from utils.metrics import db_requests
+from utils.token_counter import HeuristicTokenCounter, SERVICE_TOKEN_BUDGETS, set_token_counter
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "dispatch.json")
+SERVICES = ("gpt", "tts", "itt", "dalle", "att", "gemini")
+# The Bot API method and content every update of a service should end with, {prompt} is the message text
+EXPECTED_REPLIES = {
+    "gpt": ("editMessageText", "Streamed answer to: {prompt}"),
+    "gemini": ("editMessageText", "Gemini answer to: {prompt}"),
+    "itt": ("sendMessage", "recognized text"),
+    "att": ("sendMessage", "Transcribed text: transcribed words"),
+    "tts": ("sendVoice", ""),
+    "dalle": ("sendPhoto", "https://example.invalid/image.png"),
+}
+TOKEN = "123456:benchmark"
+
+# A 1x1 PNG, so the optional Pillow downscaling has a real image to open
+IMAGE = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+AUDIO = b"OggS" + bytes(4096)
+
+
+class FakeProviderError(Exception):
+    pass
+
+
+class FakeLatency:
+    def __init__(self, mean: float, error_rate: float, spread: float = 0.5):
+        self.mean = mean
+        self.error_rate = error_rate
+        self.spread = spread
+
+    async def wait(self) -> None:
+        # Log-normal latencies have the long right tail real provider latencies show
+        await asyncio.sleep(random.lognormvariate(0, self.spread) * self.mean if self.mean else 0)
+        if random.random() < self.error_rate:
+            raise FakeProviderError("simulated provider failure")
+
+
+class FakeOpenAIClient:
+    def __init__(self, latency: FakeLatency):
+        self.latency = latency
+
+    async def warm_up(self) -> None:
+        pass
+
+    def pool_usage(self) -> dict:
+        return {}
+
+    async def close(self) -> None:
+        pass
+
+    async def generate_response(self, user_input, history=None) -> str:
+        await self.latency.wait()
+        return f"Answer to: {user_input}"
+
+    async def stream_response(self, user_input, history=None):
+        await self.latency.wait()
+        for word in ("Streamed ", "answer ", "to: ", user_input):
+            await asyncio.sleep(0)
+            yield word
+
+    async def generate_image(self, user_input) -> str:
+        await self.latency.wait()
+        return "https://example.invalid/image.png"
+
+    async def generate_speech(self, user_input) -> bytes:
+        await self.latency.wait()
+        return AUDIO
+
+    async def transcribe_audio(self, audio_file) -> str:
+        await self.latency.wait()
+        return "transcribed words"
+
+
+class FakeGeminiClient:
+    def __init__(self, latency: FakeLatency):
+        self.latency = latency
+
+    async def generate_response(self, user_input, history=None) -> str:
+        await self.latency.wait()
+        return f"Gemini answer to: {user_input}"
+
+    async def stream_response(self, user_input, history=None):
+        await self.latency.wait()
+        for word in ("Gemini ", "answer ", "to: ", user_input):
+            await asyncio.sleep(0)
+            yield word
+
+
+class FakeVisionClient:
+    def __init__(self, latency: FakeLatency):
+        self.latency = latency
+
+    async def image_to_text_client(self, content) -> str:
+        return (await self.images_to_text([content]))[0]
+
+    async def images_to_text(self, contents: list[bytes]) -> list[str]:
+        await self.latency.wait()
+        return ["recognized text"] * len(contents)
+
+
+class FakeTelegramRequest(BaseRequest):
+    # Answers Bot API calls the way Telegram would, counts them by method and keeps what was sent per chat
+
+    def __init__(self, record_replies: bool = True):
+        self.calls = Counter()
+        self.message_ids = 0
+        self.record_replies = record_replies
+        self.replies = defaultdict(list)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        if "/file/bot" in url:
+            self.calls["download"] += 1
+            return 200, AUDIO if "/voice/" in url else IMAGE
+
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif endpoint == "getFile":
+            kind = "voice" if parameters["file_id"].startswith("voice") else "photos"
+            result = {"file_id": parameters["file_id"], "file_unique_id": parameters["file_id"],
+                      "file_size": len(AUDIO if kind == "voice" else IMAGE),
+                      "file_path": f"{kind}/{parameters['file_id']}"}
+        elif endpoint.startswith(("send", "edit")):
+            if self.record_replies:
+                # Text for messages and edits, the photo URL or the attached file for media
+                content = next((parameters[name] for name in ("text", "caption", "photo", "voice")
+                                if name in parameters), "")
+                self.replies[parameters.get("chat_id")].append((endpoint, str(content)))
+            self.message_ids += 1
+            result = {"message_id": parameters.get("message_id", self.message_ids), "date": int(time.time()),
+                      "chat": {"id": parameters.get("chat_id", 0), "type": "private"},
+                      "text": parameters.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def synthetic_update(update_id: int, user_id: int, service: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+    }
+    # Unique file ids keep the OCR cache from answering repeated images
+    if service == "itt":
+        message["photo"] = [{"file_id": f"photo-{update_id}", "file_unique_id": f"photo-{update_id}",
+                             "width": 1, "height": 1, "file_size": len(IMAGE)}]
+    elif service == "att":
+        message["voice"] = {"file_id": f"voice-{update_id}", "file_unique_id": f"voice-{update_id}",
+                            "duration": 3, "mime_type": "audio/ogg", "file_size": len(AUDIO)}
+    else:
+        message["text"] = f"synthetic request {update_id}"
+    return {"update_id": update_id, "message": message}
+
+
+def missing_replies(request: FakeTelegramRequest, updates: list, chats_per_service: int, seed: int) -> list[str]:
+    # Every update of a sampled chat has to be answered with its expected reply, each reply counts once
+    chats = defaultdict(list)
+    for service, update in updates:
+        chats[update.effective_chat.id].append((service, update.message.text))
+    sampler = random.Random(seed)
+    missing = []
+    for service in SERVICES:
+        candidates = sorted(chat_id for chat_id, prompts in chats.items() if prompts[0][0] == service)
+        for chat_id in sampler.sample(candidates, min(chats_per_service, len(candidates))):
+            replies = list(request.replies[chat_id])
+            for _, prompt in chats[chat_id]:
+                endpoint, content = EXPECTED_REPLIES[service]
+                expected = (endpoint, content.format(prompt=prompt))
+                if expected in replies:
+                    replies.remove(expected)
+                else:
+                    missing.append(f"chat {chat_id} ({service}) got no {endpoint} {expected[1]!r}")
+    return missing
+
+
+async def run(args, directory: str, trace_memory: bool) -> tuple[dict, list[str]]:
+    random.seed(args.seed)
+    latency = FakeLatency(args.latency, args.error_rate)
+    providers = ProviderRegistry()
+    for name, client in (("openai", FakeOpenAIClient(latency)), ("gemini", FakeGeminiClient(latency)),
+                         ("vision", FakeVisionClient(latency))):
+        providers.register(name, __name__, type(client).__name__)
+        providers.instances[name] = client
+
+    # tiktoken would download its vocabulary on first use
+    for service in SERVICE_TOKEN_BUDGETS:
+        set_token_counter(service, HeuristicTokenCounter())
+
+    config = {
+        "token": TOKEN,
+        "state_backend": args.backend,
+        "database_url": f"sqlite+aiosqlite:///{os.path.join(directory, 'benchmark.db')}",
+        "stream_edit_interval": 0.05,
+        # Same admission limits main.py uses without overrides
+        "provider_limits": {"openai": {"max_concurrency": 16}, "gemini": {"max_concurrency": 8},
+                            "vision": {"max_concurrency": 8}},
+    }
+    telegram_bot = TelegramBot(providers, config=config)
+    # Recorded replies would count towards the peak memory of the bot, they are checked on the timed pass
+    request = FakeTelegramRequest(record_replies=not trace_memory)
+    application = Application.builder().bot(Bot(TOKEN, request=request, get_updates_request=request)).build()
+    telegram_bot.add_handlers(application)
+
+    errors = Counter()
+
+    async def count_error(update, context) -> None:
+        errors[type(context.error).__name__] += 1
+
+    application.add_error_handler(count_error)
+
+    sql_statements = 0
+    if args.backend == "sql":
+        def count_statement(*_) -> None:
+            nonlocal sql_statements
+            sql_statements += 1
+
+        event.listen(telegram_bot.repository.engine.sync_engine, "before_cursor_execute", count_statement)
+
+    users = [(user_id, SERVICES[user_id % len(SERVICES)]) for user_id in range(1000, 1000 + args.users)]
+    updates = []
+    for update_id in range(args.updates):
+        user_id, service = users[update_id % len(users)]
+        updates.append((service, Update.de_json(synthetic_update(update_id, user_id, service), application.bot)))
+
+    async with application:
+        await telegram_bot.post_init(application)
+        for user_id, service in users:
+            await telegram_bot.repository.insert_user(user_id, "load", "Load", "Test")
+            await telegram_bot.repository.set_user_state(user_id, service)
+
+        db_before = sum(db_requests.values.values())
+        sql_before = sql_statements
+        request.calls.clear()
+        latencies = defaultdict(list)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def process(service: str, update: Update) -> None:
+            async with semaphore:
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies[service].append(time.perf_counter() - started)
+
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(process(service, update) for service, update in updates))
+        # Counters are written in batches, the final batch belongs to this run too
+        await telegram_bot.repository.request_counter.flush()
+        elapsed = time.perf_counter() - started
+        peak_memory = 0
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        db_operations = sum(db_requests.values.values()) - db_before
+        await telegram_bot.post_shutdown(application)
+
+    every = [value for values in latencies.values() for value in values]
+    result = {
+        "updates_per_second": round(args.updates / elapsed, 1),
+        "p50_ms": round(percentile(every, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(every, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(every, 0.99) * 1000, 2),
+        "db_operations_per_update": round(db_operations / args.updates, 4),
+        "telegram_calls_per_update": round(sum(request.calls.values()) / args.updates, 3),
+        "peak_memory_mb": round(peak_memory / 1024 / 1024, 2),
+        "errors": sum(errors.values()),
+        "services": {service: {"p50_ms": round(percentile(values, 0.5) * 1000, 2),
+                               "p95_ms": round(percentile(values, 0.95) * 1000, 2)}
+                     for service, values in sorted(latencies.items())},
+    }
+    if args.backend == "sql":
+        result["sql_statements_per_update"] = round((sql_statements - sql_before) / args.updates, 4)
+    if trace_memory:
+        return result, []
+    return result, missing_replies(request, updates, args.reply_sample, args.seed)
+
+
+def workload(args) -> dict:
+    return {name: getattr(args, name) for name in
+            ("updates", "users", "concurrency", "latency", "error_rate", "backend", "seed")}
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    if result["updates_per_second"] < baseline["updates_per_second"] * (1 - tolerance):
+        found.append(f"throughput {result['updates_per_second']} < {baseline['updates_per_second']} updates/s")
+    for key in ("p95_ms", "p99_ms", "peak_memory_mb"):
+        if result[key] > baseline[key] * (1 + tolerance):
+            found.append(f"{key} {result[key]} > {baseline[key]}")
+    # Flush timing and streaming edits vary a little between runs, a real change moves these by much more
+    for key in ("db_operations_per_update", "sql_statements_per_update", "telegram_calls_per_update"):
+        if key in baseline and result.get(key, 0) > baseline[key] * (1 + tolerance) + 0.01:
+            found.append(f"{key} {result[key]} > {baseline[key]}")
+    return found
+
+
+def main(args) -> int:
+    # Handlers log every request and every simulated failure, which would dominate the measurement
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    # tracemalloc slows every allocation down, so timings and peak memory come from two identical passes
+    with tempfile.TemporaryDirectory() as directory:
+        result, missing = asyncio.run(run(args, directory, trace_memory=False))
+    with tempfile.TemporaryDirectory() as directory:
+        result["peak_memory_mb"] = asyncio.run(run(args, directory, trace_memory=True))[0]["peak_memory_mb"]
+
+    print(f"workload:            {workload(args)}")
+    for key, value in result.items():
+        if key != "services":
+            print(f"{key + ':':<30} {value}")
+    for service, values in result["services"].items():
+        print(f"  {service:<8} p50 {values['p50_ms']} ms, p95 {values['p95_ms']} ms")
+
+    # Simulated provider failures are answered with an error message instead, each explains one missing reply
+    for reply in missing[:5]:
+        print(f"missing reply: {reply}")
+    if len(missing) > result["errors"]:
+        print(f"WRONG REPLIES: {len(missing)} sampled updates missed their reply, "
+              f"only {result['errors']} simulated failures")
+        return 1
+    print(f"replies: {len(missing)} sampled updates without their expected reply, "
+          f"{result['errors']} simulated failures")
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baselines = json.load(file)
+    key = json.dumps(workload(args), sort_keys=True)
+
+    if args.update_baseline:
+        baselines[key] = result
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"baseline for this workload stored in {args.baseline}")
+        return 0
+    if key not in baselines:
+        print(f"no baseline for this workload in {args.baseline}, store one with --update-baseline")
+        return 0
+
+    found = regressions(result, baselines[key], args.tolerance)
+    for regression in found:
+        print(f"REGRESSION: {regression}")
+    if not found:
+        print("no regression against the stored baseline")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.02, help="median fake provider latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--backend", choices=("sql", "memory"), default="sql")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="store this run as the baseline of its workload, nothing is written without it")
+    parser.add_argument("--reply-sample", type=int, default=5,
+                        help="chats per service whose replies are checked")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own logging")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative slowdown before a result counts as a regression")
+    raise SystemExit(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+"""Replays simulated provider latencies through HedgedTextClient and reports hedge rate and p99 gains.
+
+Each fake provider usually answers after a log-normal delay and sometimes stalls or fails, so the effect
+of the p95 hedge deadline on tail latency can be checked without calling OpenAI or Gemini. Every attempt
+takes a slot from the scheduler of its provider, as in the bot, with --provider-concurrency slots each:
+
+    python -m benchmarks.hedging_benchmark --requests 2000 --concurrency 50 --stall-rate 0.03 --hedges 2
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from clients.hedged_client import HedgedTextClient, percentile
+from utils.scheduler import Scheduler
+
+
+class FakeProvider:
+    def __init__(self, name: str, median: float, stall_rate: float, stall_seconds: float, error_rate: float):
+        self.name = name
+        self.median = median
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.error_rate = error_rate
+
+    async def stream_response(self, user_input, history=None):
+        if random.random() < self.error_rate:
+            await asyncio.sleep(self.median / 4)
+            raise RuntimeError(f"{self.name} unavailable")
+        delay = random.lognormvariate(0, 0.4) * self.median
+        if random.random() < self.stall_rate:
+            delay += self.stall_seconds
+        await asyncio.sleep(delay)
+        for word in ("simulated", " answer"):
+            yield word
+
+
+async def run(client, scheduler: Scheduler, requests: int, concurrency: int) -> list[float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(user_id: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async for _ in client.stream_response(
+                        "question", slot=lambda provider: scheduler.slot(provider, user_id)):
+                    latencies.append(time.perf_counter() - started)
+                    break
+            except RuntimeError:
+                pass
+
+    await asyncio.gather(*(one(user_id) for user_id in range(requests)))
+    return latencies
+
+
+async def main(args) -> None:
+    # Hedges and simulated failures are logged per request, keep them out of the output
+    logging.getLogger("clients.hedged_client").setLevel(logging.ERROR)
+    random.seed(args.seed)
+    # The primary and --hedges fallbacks, each a little slower than the one before
+    names = ["openai", "gemini"] + [f"backup-{index}" for index in range(1, args.hedges)]
+    providers = [(name, FakeProvider(name, args.median * (1 + 0.2 * index), args.stall_rate, args.stall_seconds,
+                                     args.error_rate))
+                 for index, name in enumerate(names[:args.hedges + 1])]
+
+    def scheduler() -> Scheduler:
+        return Scheduler({name: {"max_concurrency": args.provider_concurrency} for name, _ in providers})
+
+    baseline = await run(HedgedTextClient(providers[:1]), scheduler(), args.requests, args.concurrency)
+    hedged_client = HedgedTextClient(providers, initial_deadline=args.median * 3, min_deadline=args.median)
+    hedged_scheduler = scheduler()
+    hedged = await run(hedged_client, hedged_scheduler, args.requests, args.concurrency)
+
+    stats = hedged_client.stats()
+    for label, samples in (("primary only", baseline), ("hedged", hedged)):
+        print(f"{label:13} answered {len(samples)}/{args.requests}, "
+              f"p50 {percentile(samples, 0.5):.3f} s, p95 {percentile(samples, 0.95):.3f} s, "
+              f"p99 {percentile(samples, 0.99):.3f} s")
+    print(f"hedge rate:   {stats['hedge_rate']:.1%}, failovers: {stats['failovers']}, wins: {stats['wins']}")
+    for name, provider in hedged_scheduler.stats().items():
+        print(f"{name:13} slots granted {provider['granted']}, max wait {provider['max_wait']:.3f} s")
+    print(f"p99 improvement over primary only: "
+          f"{percentile(baseline, 0.99) - percentile(hedged, 0.99):.3f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--median", type=float, default=0.05, help="median first token latency in seconds")
+    parser.add_argument("--stall-rate", type=float, default=0.03)
+    parser.add_argument("--stall-seconds", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--hedges", type=int, default=1, help="fallback providers after the primary")
+    parser.add_argument("--provider-concurrency", type=int, default=64, help="scheduler slots per provider")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,61 @@
+"""Measures durable job queue throughput offline with handlers that only sleep.
+
+    python -m benchmarks.job_queue_benchmark --jobs 2000 --workers 8 --handler-latency 0.01
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from jobs.job_queue import Job, JobQueue
+
+
+async def main(args) -> None:
+    # Retries of synthetic failures are expected, keep them out of the output
+    logging.getLogger("jobs.job_queue").setLevel(logging.ERROR)
+    with tempfile.TemporaryDirectory() as directory:
+        queue = JobQueue(os.path.join(directory, "jobs.db"), workers=args.workers, backoff_base=0.01)
+        done = asyncio.Event()
+        finished = 0
+        failed_once = set()
+
+        async def handler(job: Job) -> None:
+            nonlocal finished
+            payload = job.payload
+            await asyncio.sleep(args.handler_latency)
+            # The first attempt of failure_percent of the jobs fails to exercise retries
+            if payload["index"] % 100 < args.failure_percent and payload["index"] not in failed_once:
+                failed_once.add(payload["index"])
+                raise RuntimeError("synthetic failure")
+            finished += 1
+            if finished == args.jobs:
+                done.set()
+
+        queue.register("benchmark", handler)
+
+        started = time.perf_counter()
+        for index in range(args.jobs):
+            await queue.enqueue("benchmark", {"index": index})
+        enqueued = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await queue.start()
+        await done.wait()
+        processed = time.perf_counter() - started
+        await queue.stop()
+
+    print(f"jobs:               {args.jobs}")
+    print(f"enqueued per second: {args.jobs / enqueued:.0f}")
+    print(f"processed per second: {args.jobs / processed:.0f}")
+    print(f"queue stats:        {queue.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--handler-latency", type=float, default=0.01)
+    parser.add_argument("--failure-percent", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
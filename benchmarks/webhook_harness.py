@@ -0,0 +1,115 @@
+"""Posts synthetic Telegram updates to a webhook endpoint and reports throughput.
+
+Without --url an in-process WebhookServer is started with a stub application whose handlers only sleep,
+so ingestion and worker throughput can be measured without the Telegram API:
+
+    python -m benchmarks.webhook_harness --updates 5000 --connections 32 --handler-latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+from bot.webhook_server import WebhookServer
+
+
+class StubApplication:
+    def __init__(self, latency: float):
+        self.bot = None
+        self.latency = latency
+
+    async def process_update(self, update) -> None:
+        await asyncio.sleep(self.latency)
+
+
+def synthetic_update(update_id: int, users: int) -> dict:
+    user_id = 1000 + update_id % users
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+            "text": f"synthetic message {update_id}",
+        },
+    }
+
+
+async def post_updates(host: str, port: int, path: str, update_ids: list[int], users: int, secret: str,
+                       latencies: list[float]) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for update_id in update_ids:
+            body = json.dumps(synthetic_update(update_id, users)).encode()
+            head = (
+                f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                + (f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n" if secret else "")
+                + "\r\n"
+            )
+            started = time.perf_counter()
+            writer.write(head.encode() + body)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":", 1)[1])
+            await reader.readexactly(length)
+            if b" 200 " not in status_line:
+                raise RuntimeError(f"Unexpected response: {status_line!r}")
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+
+
+async def main(args) -> None:
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port, path = url.hostname, url.port or 80, url.path or "/"
+    else:
+        server = WebhookServer(StubApplication(args.handler_latency), listen="127.0.0.1", port=0,
+                               secret_token=args.secret, workers=args.workers, queue_size=args.updates)
+        await server.start()
+        host, port, path = "127.0.0.1", server.port, server.path
+
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        post_updates(host, port, path, list(range(connection, args.updates, args.connections)), args.users,
+                     args.secret, latencies)
+        for connection in range(args.connections)
+    ))
+    accepted = time.perf_counter() - started
+
+    if server is not None:
+        await server.queue.join()
+    processed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"updates:            {args.updates}")
+    print(f"accepted per second: {args.updates / accepted:.0f}")
+    if server is not None:
+        print(f"processed per second: {server.processed / processed:.0f}")
+        await server.stop()
+    print(f"post latency p50:   {latencies[len(latencies) // 2] * 1000:.2f} ms")
+    print(f"post latency p99:   {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="webhook URL of a running bot, an in-process server is used when omitted")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--handler-latency", type=float, default=0.05)
+    parser.add_argument("--secret")
+    asyncio.run(main(parser.parse_args()))
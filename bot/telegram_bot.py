@@ -1,7 +1,16 @@
+import asyncio
+import contextlib
+import csv
+import gzip
 import logging
+import signal
+import tempfile
+import time
+from types import SimpleNamespace
 
-from pydub import AudioSegment
+from cachetools import TTLCache
 from telegram import BotCommand, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     CallbackContext,
     Application,
@@ -11,41 +20,147 @@ from telegram.ext import (
     ContextTypes, CallbackQueryHandler,
 )
 
-from clients.gemini_client import GeminiClient
-from clients.openai_client import OpenAIClient
-from clients.vision_client import VisionClient
-from repositories.user_repository import UserRepository
-from utils.delete_file import delete_file_if_exists
-from utils.token_counter import validate_user_input
+from bot.webhook_server import WebhookServer
+from clients.hedged_client import HedgedTextClient
+from clients.provider_registry import ProviderRegistry, ProviderUnavailableError
+from jobs.job_queue import Job, JobQueue, PermanentJobError
+from repositories.repository_factory import create_user_repository
+from utils.audio import audio_format, prepare_for_transcription, split_on_silence_bounded
+from utils.conversation_memory import ConversationMemory
+from utils.http_pool import http2_supported, pool_usage
+from utils.images import downscale_image
+from utils.metrics import (
+    cache_requests,
+    registry,
+    stage,
+    update_errors,
+    update_requests,
+    update_seconds,
+)
+from utils.profiler import SamplingProfiler
+from utils.response_cache import ResponseCache
+from utils.scheduler import Scheduler
+from utils.stream_reply import StreamingReply, send_long_text, split_message
+from utils.token_counter import count_tokens, load_token_counters, validate_user_input
+from utils.tracing import span, trace
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+SERVICE_PROVIDERS = {
+    "gpt": "openai",
+    "tts": "openai",
+    "itt": "vision",
+    "dalle": "openai",
+    "att": "openai",
+    "gemini": "gemini",
+    # Fastest answer attempts are admitted by the provider each one goes to, see text_reply
+    "fast": "fast",
+}
+
+# Providers the fastest answer mode can use, the first available one is the primary
+HEDGE_PROVIDERS = ("openai", "gemini")
+
 
 class TelegramBot:
-    def __init__(
-            self, openai_client: OpenAIClient, vision_client: VisionClient, gemini_client: GeminiClient, config: dict
-    ):
-        self.openai_client = openai_client
-        self.vision_client = vision_client
-        self.gemini_client = gemini_client
-        self.repository = UserRepository()
+    def __init__(self, providers: ProviderRegistry, config: dict):
+        self.providers = providers
+        self.repository = create_user_repository(config)
         self.config = config
+        self.response_cache = ResponseCache(
+            config.get("response_cache_services", {}),
+            maxsize=config.get("response_cache_size", 1000),
+            path=config.get("response_cache_path"),
+        )
+        self.ocr_cache = TTLCache(maxsize=config.get("ocr_cache_size", 5000), ttl=config.get("ocr_cache_ttl", 86400))
+        self.memory = None
+        if config.get("conversation_memory", True):
+            self.memory = ConversationMemory(
+                max_turns=config.get("conversation_max_turns", 20),
+                token_budget=config.get("conversation_token_budget", 3000),
+                max_sessions=config.get("conversation_max_sessions", 10000),
+                idle_ttl=config.get("conversation_idle_ttl", 1800),
+                summarizer=self.summarize_conversation if config.get("conversation_summaries") else None,
+            )
+        self.scheduler = Scheduler(config.get("provider_limits", {}))
+        self.metrics_server = None
+        self.profiler = SamplingProfiler()
+        self.media_groups = {}
+        self.background_tasks = set()
+        self.provider_warm_up = None
+        self.application = None
+        self.jobs = None
+        self.hedged_client = None
+        if config.get("job_queue_enabled"):
+            self.jobs = JobQueue(
+                path=config.get("job_queue_path", "bot_jobs.db"),
+                workers=config.get("job_workers", 4),
+                max_attempts=config.get("job_max_attempts", 5),
+                lease_seconds=config.get("job_lease_seconds", 60.0),
+                # A disabled provider or a request Telegram rejects fails the same way on every attempt
+                permanent_errors=(ProviderUnavailableError, BadRequest),
+            )
+            self.jobs.register("transcribe", self.run_transcription_job, on_failure=self.job_failed)
+            self.jobs.register("image", self.run_image_job, on_failure=self.job_failed)
+        self.register_metrics()
         self.commands = [
             BotCommand(command="help", description="Show help message"),
             BotCommand(command="start", description="Show welcome message"),
             BotCommand(command="stats", description="Show user statistics"),
             BotCommand(command="state", description="Show currently chosen service"),
             BotCommand(command="menu", description="Show services menu"),
+            BotCommand(command="reset", description="Clear conversation history"),
         ]
-        self.keyboard = [[InlineKeyboardButton("ChatGPT4-Turbo", callback_data='gpt'),
-                          InlineKeyboardButton("Text to Speech", callback_data='tts')],
-                         [InlineKeyboardButton("Image to Text", callback_data='itt'),
-                          InlineKeyboardButton("Image generation", callback_data='dalle')],
-                         [InlineKeyboardButton("Audio transcribing", callback_data='att'),
-                          InlineKeyboardButton("Google Gemini", callback_data='gemini')]]
+        self.services = [("ChatGPT4-Turbo", 'gpt'), ("Text to Speech", 'tts'),
+                         ("Image to Text", 'itt'), ("Image generation", 'dalle'),
+                         ("Audio transcribing", 'att'), ("Google Gemini", 'gemini'),
+                         ("Fastest answer", 'fast')]
+
+    @property
+    def openai_client(self):
+        return self.providers.get("openai")
+
+    @property
+    def vision_client(self):
+        return self.providers.get("vision")
+
+    @property
+    def gemini_client(self):
+        return self.providers.get("gemini")
+
+    @property
+    def fast_client(self):
+        if self.hedged_client is None:
+            order = self.config.get("hedge_providers", HEDGE_PROVIDERS)
+            clients = []
+            for name in order:
+                try:
+                    clients.append((name, self.providers.get(name)))
+                except ProviderUnavailableError:
+                    logger.warning(f"{name} provider is not available for fastest answers")
+            if not clients:
+                raise ProviderUnavailableError("fast")
+            self.hedged_client = HedgedTextClient(
+                clients,
+                initial_deadline=self.config.get("hedge_initial_deadline", 2.0),
+                min_deadline=self.config.get("hedge_min_deadline", 0.5),
+                max_deadline=self.config.get("hedge_max_deadline", 10.0),
+            )
+        return self.hedged_client
+
+    def service_available(self, service: str) -> bool:
+        if service == "fast":
+            return any(self.providers.is_available(name)
+                       for name in self.config.get("hedge_providers", HEDGE_PROVIDERS))
+        return self.providers.is_available(SERVICE_PROVIDERS[service])
+
+    @property
+    def keyboard(self):
+        buttons = [InlineKeyboardButton(title, callback_data=service)
+                   for title, service in self.services if self.service_available(service)]
+        return [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user = update.effective_user
@@ -59,8 +174,8 @@ class TelegramBot:
         await self.show_menu(update, context)
 
     async def add_user_to_db(self, user):
-        if not self.repository.user_exists(user.id):
-            self.repository.insert_user(
+        if not await self.repository.user_exists(user.id):
+            await self.repository.insert_user(
                 user.id, user.username, user.first_name, user.last_name
             )
 
@@ -83,15 +198,11 @@ class TelegramBot:
 
         user_input = update.message.text.strip()
 
-        if validate_user_input(user_input):
-            await update.message.reply_text(
-                "Please wait, your request is processing, for large responses it can take a while!"
-            )
+        if validate_user_input(user_input, service="gpt"):
             logger.info(f"User {update.effective_user.id}: input sent to gpt model...")
-            generated_text = await self.openai_client.generate_response(user_input)
-            await update.message.reply_text(generated_text)
+            await self.text_reply(update, "gpt", self.openai_client, user_input)
             logger.info(f"User {update.effective_user.id}: response sent back...")
-            self.repository.update_request_count(update.effective_user.id, "gpt")
+            await self.repository.update_request_count(update.effective_user.id, "gpt")
         else:
             await update.message.reply_text(
                 "Too many characters. Please try again with less characters."
@@ -104,24 +215,98 @@ class TelegramBot:
 
         user_input = update.message.text.strip()
 
-        if validate_user_input(user_input):
+        if validate_user_input(user_input, service="gemini"):
+            logger.info(f"User {update.effective_user.id}: input sent to gemini model...")
+            await self.text_reply(update, "gemini", self.gemini_client, user_input)
+            logger.info(f"User {update.effective_user.id}: response sent back...")
+            await self.repository.update_request_count(update.effective_user.id, "gemini")
+        else:
             await update.message.reply_text(
-                "Please wait, your request is processing, for large responses it can take a while!"
+                "Too many characters. Please try again with less characters."
             )
-            logger.info(f"User {update.effective_user.id}: input sent to gemini model...")
-            generated_text = await self.gemini_client.generate_response(user_input)
-            await update.message.reply_text(generated_text)
+
+    async def generate_fast_response(
+            self, update: Update, context: CallbackContext
+    ) -> None:
+        await self.add_user_to_db(update.effective_user)
+
+        user_input = update.message.text.strip()
+
+        if validate_user_input(user_input, service="fast"):
+            logger.info(f"User {update.effective_user.id}: input sent to fastest answer models...")
+            await self.text_reply(update, "fast", self.fast_client, user_input)
             logger.info(f"User {update.effective_user.id}: response sent back...")
-            self.repository.update_request_count(update.effective_user.id, "gemini")
+            await self.repository.update_request_count(update.effective_user.id, "fastest-answer")
         else:
             await update.message.reply_text(
                 "Too many characters. Please try again with less characters."
             )
 
+    async def text_reply(self, update: Update, service: str, client, user_input: str) -> None:
+        user_id = update.effective_user.id
+        history = self.memory.history(user_id, service) if self.memory else []
+        # The history is sent along with the input, so it counts against the token rate limit too
+        tokens = count_tokens(user_input, service) + sum(count_tokens(text, service) for _, text in history)
+        # Fastest answers take a slot for every attempt, from the scheduler of the provider it goes to
+        attempt_slots = {}
+        if service == "fast":
+            attempt_slots["slot"] = lambda provider: self.scheduler.slot(provider, user_id, tokens=tokens)
+        replied = False
+
+        async def compute() -> str:
+            nonlocal replied
+            replied = True
+            if self.config.get("streaming_replies", True):
+                return await self.stream_reply(update, self.admitted_stream(
+                    service, update, tokens, client.stream_response(user_input, history, **attempt_slots)
+                ))
+
+            await update.message.reply_text(
+                "Please wait, your request is processing, for large responses it can take a while!"
+            )
+            async with self.provider_slot(service, update, tokens):
+                generated_text = await client.generate_response(user_input, history, **attempt_slots)
+            await send_long_text(update.message, generated_text)
+            return generated_text
+
+        # Answers that depend on earlier turns are never shared through the cache
+        if self.response_cache.enabled_for(service) and not history:
+            generated_text = await self.response_cache.get_or_compute(service, user_input, compute)
+            # Cache hits and coalesced requests still have to be delivered to this user
+            if not replied:
+                await send_long_text(update.message, generated_text)
+        else:
+            generated_text = await compute()
+
+        if self.memory:
+            await self.memory.add_exchange(user_id, service, user_input, generated_text)
+
+    async def summarize_conversation(self, user_id: int, transcript: str) -> str:
+        # Summaries are OpenAI calls like any other, whichever service the conversation belongs to
+        async with self.scheduler.slot("openai", user_id, tokens=count_tokens(transcript)):
+            return await self.openai_client.generate_response(
+                "Summarize the following conversation in a few sentences, keeping names, facts and open questions:"
+                "\n\n" + transcript
+            )
+
+    async def reset_command(self, update: Update, context: CallbackContext) -> None:
+        await self.add_user_to_db(update.effective_user)
+        if self.memory:
+            self.memory.reset(update.effective_user.id)
+        await update.message.reply_text("Conversation history cleared, the next message starts a new conversation!")
+
+    async def stream_reply(self, update: Update, chunks) -> str:
+        reply = StreamingReply(
+            update.message,
+            "Please wait, your request is processing, for large responses it can take a while!",
+            edit_interval=self.config.get("stream_edit_interval", 1.0),
+        )
+        return await reply.send(chunks)
+
     async def stats_command(self, update: Update, context: CallbackContext) -> None:
         await self.add_user_to_db(update.effective_user)
 
-        result = self.repository.get_service_counts(update.effective_user.id)
+        result = await self.repository.get_service_counts(update.effective_user.id)
         result_string = "Your total request so far:\n"
         for service, count in result.items():
             service_name = "-".join(word.capitalize() for word in service.split("-"))
@@ -142,15 +327,29 @@ class TelegramBot:
 
         user_input = update.message.text.replace("/image", "").strip()
 
-        if validate_user_input(user_input):
+        if validate_user_input(user_input, service="dalle"):
+            if self.jobs is not None:
+                await self.jobs.enqueue("image", {
+                    "chat_id": update.effective_chat.id,
+                    "message_id": update.message.message_id,
+                    "user_id": update.effective_user.id,
+                    "prompt": user_input,
+                })
+                await update.message.reply_text(
+                    "Your request is queued, the image will be sent as soon as it is ready!"
+                )
+                return
+
             await update.message.reply_text(
                 "Please wait, your request is processing, for large responses and images it can take a while!"
             )
             logger.info(f"User {update.effective_user.id}: input sent to dalle model...")
-            response = await self.openai_client.generate_image(user_input)
-            await update.message.reply_photo(response)
+            response = await self.generate_image(user_input, update.effective_user.id,
+                                                 on_queued=self.queued_notice(update))
+            with stage("reply_send"):
+                await update.message.reply_photo(response)
             logger.info(f"User {update.effective_user.id}: response sent back...")
-            self.repository.update_request_count(
+            await self.repository.update_request_count(
                 update.effective_user.id, "image-generation"
             )
         else:
@@ -158,26 +357,56 @@ class TelegramBot:
                 "Please provide valid input. Example: /image cute cat"
             )
 
+    async def generate_image(self, user_input: str, user_id: int, on_queued=None) -> str:
+        # Only the call that reaches OpenAI is admitted, cache hits and coalesced requests skip the queue
+        async def compute() -> str:
+            async with self.scheduler.slot("openai", user_id, tokens=count_tokens(user_input, "dalle"),
+                                           on_queued=on_queued):
+                return await self.openai_client.generate_image(user_input)
+
+        if self.response_cache.enabled_for("dalle"):
+            return await self.response_cache.get_or_compute("dalle", user_input, compute)
+        return await compute()
+
+    async def run_image_job(self, job: Job) -> None:
+        payload = job.payload
+        if not validate_user_input(payload["prompt"], service="dalle"):
+            raise PermanentJobError("Invalid image prompt")
+        # Steps finished by an earlier attempt are not repeated, the image is generated and sent once
+        if "image_url" not in job.steps:
+            if not self.service_available("dalle"):
+                raise ProviderUnavailableError(SERVICE_PROVIDERS["dalle"])
+            with span("handler.dalle"):
+                response = await self.generate_image(payload["prompt"], payload["user_id"])
+            await self.jobs.record_step(job, image_url=response)
+        if not job.steps.get("sent"):
+            with stage("reply_send"):
+                await self.application.bot.send_photo(payload["chat_id"], job.steps["image_url"],
+                                                      reply_to_message_id=payload["message_id"])
+            logger.info(f"User {payload['user_id']}: response sent back...")
+            await self.jobs.record_step(job, sent=True)
+        await self.repository.update_request_count(payload["user_id"], "image-generation")
+
     async def tts_command(self, update: Update, context: CallbackContext) -> None:
         await self.add_user_to_db(update.effective_user)
 
         user_input = update.message.text.replace("/tts", "").strip()
 
-        if validate_user_input(user_input):
+        if validate_user_input(user_input, service="tts"):
             await update.message.reply_text(
                 "Please wait, your request is processing, for large responses it can take a while!"
             )
             logger.info(
                 f"User {update.effective_user.id}: input sent to text-to-speech model..."
             )
-            response = await self.openai_client.generate_speech(user_input)
-            await update.message.reply_voice(response)
+            async with self.provider_slot("tts", update, count_tokens(user_input, "tts")):
+                response = await self.openai_client.generate_speech(user_input)
+            with stage("reply_send"):
+                await update.message.reply_voice(response)
             logger.info(f"User {update.effective_user.id}: response sent back...")
-            self.repository.update_request_count(
+            await self.repository.update_request_count(
                 update.effective_user.id, "text-to-speech"
             )
-            if response.exists():
-                response.unlink()
         else:
             await update.message.reply_text(
                 "Please provide valid input. Example: /tts Hello from ai speech"
@@ -186,63 +415,216 @@ class TelegramBot:
     async def image_to_text(self, update: Update, context: CallbackContext) -> None:
         await self.add_user_to_db(update.effective_user)
 
-        if update.message.photo:
-            input_image_id = update.message.photo[-1].file_id
-        elif update.message.document and update.message.document.mime_type.startswith(
-                "image"
-        ):
-            input_image_id = update.message.document.file_id
-        else:
+        input_image = self.input_image(update.message)
+        if input_image is None:
             await update.message.reply_text("Please send a valid photo or image file.")
             return
 
-        image_name = f"{input_image_id}.jpeg"
-        input_image = await context.bot.get_file(input_image_id)
-        await input_image.download_to_drive(image_name)
-
-        with open(image_name, "rb") as image_file:
-            content = image_file.read()
+        if update.message.media_group_id:
+            self.collect_media_group(update, context)
+            return
 
         await update.message.reply_text(
             "Please wait, your request is processing, for large responses it can take a while!"
         )
         logger.info(f"User {update.effective_user.id}: input sent to google vision...")
-        response = await self.vision_client.image_to_text_client(content)
-        await update.message.reply_text(response)
+        response = (await self.recognize_texts(context, [input_image], update))[0]
+        await send_long_text(update.message, response)
         logger.info(f"User {update.effective_user.id}: response sent back...")
-        self.repository.update_request_count(update.effective_user.id, "image-to-text")
+        await self.repository.update_request_count(update.effective_user.id, "image-to-text")
+
+    @staticmethod
+    def input_image(message):
+        if message.photo:
+            return message.photo[-1]
+        if message.document and (message.document.mime_type or "").startswith("image"):
+            return message.document
+        return None
+
+    def collect_media_group(self, update: Update, context: CallbackContext) -> None:
+        # Photos of an album arrive as separate updates, gather them for a short window and recognize them together
+        group_id = update.message.media_group_id
+        if group_id in self.media_groups:
+            self.media_groups[group_id].append(update)
+            return
+
+        self.media_groups[group_id] = [update]
+        task = asyncio.create_task(self.process_media_group(group_id, context))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
 
-        delete_file_if_exists(image_name)
+    async def process_media_group(self, group_id: str, context: CallbackContext) -> None:
+        await asyncio.sleep(self.config.get("media_group_window", 1.0))
+        with trace(f"Album {group_id}", slow_threshold=self.config.get("slow_update_seconds", 20)):
+            await self.recognize_media_group(group_id, context)
+
+    async def recognize_media_group(self, group_id: str, context: CallbackContext) -> None:
+        updates = sorted(self.media_groups.pop(group_id), key=lambda item: item.message.message_id)
+        first_message = updates[0].message
+        user_id = updates[0].effective_user.id
+
+        try:
+            await first_message.reply_text(
+                f"Please wait, {len(updates)} images are processing, for large responses it can take a while!"
+            )
+            logger.info(f"User {user_id}: album of {len(updates)} images sent to google vision...")
+            texts = await self.recognize_texts(context, [self.input_image(item.message) for item in updates],
+                                               updates[0])
+            response = "\n\n".join(f"Image {index}:\n{text}" for index, text in enumerate(texts, start=1))
+            await send_long_text(first_message, response)
+            logger.info(f"User {user_id}: response sent back...")
+            await self.repository.update_request_count(user_id, "image-to-text", amount=len(updates))
+        except Exception:
+            logger.exception(f"User {user_id}: failed to process album {group_id}")
+            await first_message.reply_text("Something went wrong. We are working on it!")
+
+    async def recognize_texts(self, context: CallbackContext, input_images: list, update: Update) -> list[str]:
+        # Forwarded and re-sent images keep their file_unique_id, so they are recognized only once
+        results = [self.ocr_cache.get(image.file_unique_id) for image in input_images]
+        missing = [index for index, result in enumerate(results) if result is None]
+        cache_requests.inc(len(results) - len(missing), cache="ocr", result="hit")
+        cache_requests.inc(len(missing), cache="ocr", result="miss")
+        if not missing:
+            return results
+
+        contents = await asyncio.gather(*(self.download_image(context, input_images[index]) for index in missing))
+        async with self.provider_slot("itt", update):
+            texts = await self.vision_client.images_to_text(list(contents))
+        for index, text in zip(missing, texts):
+            if text is None:
+                # Failures are answered but never cached, the next attempt asks Vision again
+                results[index] = "Something went wrong. We are working on it!"
+                continue
+            self.ocr_cache[input_images[index].file_unique_id] = text
+            results[index] = text
+        return results
+
+    async def download_image(self, context: CallbackContext, input_image) -> bytes:
+        with stage("download"):
+            image_file = await context.bot.get_file(input_image.file_id)
+            content = bytes(await image_file.download_as_bytearray())
+        max_side = self.config.get("ocr_max_image_side")
+        if max_side:
+            with stage("downscale"):
+                content = await asyncio.to_thread(downscale_image, content, max_side)
+        return content
 
     async def transcribe_command(
             self, update: Update, context: CallbackContext
     ) -> None:
         await self.add_user_to_db(update.effective_user)
 
-        filename = update.message.effective_attachment.file_unique_id
-        filename_mp3 = f"{filename}.mp3"
-        media_file = await context.bot.get_file(
-            update.message.effective_attachment.file_id
-        )
-        await media_file.download_to_drive(filename)
-        audio_track = AudioSegment.from_file(filename)
-        audio_track.export(filename_mp3, format="mp3")
+        attachment = update.message.effective_attachment
+        if self.jobs is not None:
+            await self.jobs.enqueue("transcribe", {
+                "chat_id": update.effective_chat.id,
+                "message_id": update.message.message_id,
+                "user_id": update.effective_user.id,
+                "file_id": attachment.file_id,
+                "file_name": getattr(attachment, "file_name", None),
+                "mime_type": getattr(attachment, "mime_type", None),
+                "duration": getattr(attachment, "duration", None),
+            })
+            await update.message.reply_text(
+                "Your audio is queued, the transcription will be sent as soon as it is ready!"
+            )
+            return
 
-        audio_file = open(filename_mp3, "rb")
-        await update.message.reply_text(
+        with stage("download"):
+            media_file = await context.bot.get_file(attachment.file_id)
+            data = bytes(await media_file.download_as_bytearray())
+
+        progress_message = await update.message.reply_text(
             "Please wait, your request is processing, for large responses it can take a while!"
         )
         logger.info(
             f"User {update.effective_user.id}: input sent to transcribe model..."
         )
-        generated_text = await self.openai_client.transcribe_audio(audio_file)
-        await update.message.reply_text("Transcribed text: " + generated_text)
+        generated_text = await self.transcribe(data, attachment, progress_message, update.effective_user.id,
+                                               on_queued=self.queued_notice(update))
+        await send_long_text(update.message, "Transcribed text: " + generated_text)
         logger.info(f"User {update.effective_user.id}: response sent back...")
-        self.repository.update_request_count(update.effective_user.id, "audio-to-text")
-        audio_file.close()
+        await self.repository.update_request_count(update.effective_user.id, "audio-to-text")
+
+    async def run_transcription_job(self, job: Job) -> None:
+        payload = job.payload
+        bot = self.application.bot
+        # Steps finished by an earlier attempt are not repeated, the audio is transcribed once and
+        # a retry only sends the parts of the answer that did not go out yet
+        if "text" not in job.steps:
+            if not self.service_available("att"):
+                raise ProviderUnavailableError(SERVICE_PROVIDERS["att"])
+            attachment = SimpleNamespace(file_name=payload["file_name"], mime_type=payload["mime_type"],
+                                         duration=payload["duration"])
+            with stage("download"):
+                media_file = await bot.get_file(payload["file_id"])
+                data = bytes(await media_file.download_as_bytearray())
+
+            progress_message = None
+            if self.is_long_audio(data, attachment) and not job.steps.get("progress_sent"):
+                progress_message = await bot.send_message(payload["chat_id"], "Transcribing long audio...",
+                                                          reply_to_message_id=payload["message_id"])
+                await self.jobs.record_step(job, progress_sent=True)
+            with span("handler.att"):
+                generated_text = await self.transcribe(data, attachment, progress_message, payload["user_id"])
+            await self.jobs.record_step(job, text=generated_text)
+
+        parts = split_message("Transcribed text: " + job.steps["text"])
+        with stage("reply_send"):
+            for index in range(job.steps.get("sent_parts", 0), len(parts)):
+                await bot.send_message(payload["chat_id"], parts[index], reply_to_message_id=payload["message_id"])
+                await self.jobs.record_step(job, sent_parts=index + 1)
+        logger.info(f"User {payload['user_id']}: response sent back...")
+        await self.repository.update_request_count(payload["user_id"], "audio-to-text")
 
-        delete_file_if_exists(filename_mp3)
-        delete_file_if_exists(filename)
+    async def job_failed(self, job: Job) -> None:
+        await self.application.bot.send_message(job.payload["chat_id"],
+                                                "Sorry, your request could not be completed. Please try again later!",
+                                                reply_to_message_id=job.payload["message_id"])
+
+    async def transcribe(self, data: bytes, attachment, progress_message, user_id: int, on_queued=None) -> str:
+        if self.is_long_audio(data, attachment):
+            return await self.transcribe_long_audio(data, attachment, progress_message, user_id, on_queued)
+        with stage("transcode"):
+            file_name, data = await prepare_for_transcription(data, attachment)
+        async with self.scheduler.slot("openai", user_id, on_queued=on_queued):
+            return await self.openai_client.transcribe_audio((file_name, data))
+
+    def is_long_audio(self, data: bytes, attachment) -> bool:
+        duration = getattr(attachment, "duration", None) or 0
+        return (len(data) > self.config.get("long_audio_bytes", 8 * 1024 * 1024)
+                or duration > self.config.get("long_audio_seconds", 600))
+
+    async def transcribe_long_audio(self, data: bytes, attachment, progress_message, user_id: int,
+                                    on_queued=None) -> str:
+        with stage("split"):
+            segments = await asyncio.to_thread(
+                split_on_silence_bounded, data, audio_format(attachment),
+                max_segment_ms=self.config.get("long_audio_segment_seconds", 300) * 1000,
+            )
+        semaphore = asyncio.Semaphore(self.config.get("transcription_workers", 4))
+        finished = 0
+
+        async def transcribe(index: int, segment: bytes) -> str:
+            nonlocal finished
+            async with semaphore:
+                text = await self.openai_client.transcribe_audio((f"segment-{index}.mp3", segment))
+            finished += 1
+            # A retried job does not send a second progress message, see run_transcription_job
+            if progress_message is not None:
+                try:
+                    await progress_message.edit_text(
+                        f"Transcribing long audio: {finished}/{len(segments)} parts done..."
+                    )
+                except TelegramError:
+                    logger.warning("Could not update transcription progress")
+            return text.strip()
+
+        # One recording is admitted once as a whole, per-segment slots would cap it at PER_USER_MAX_IN_FLIGHT
+        # parallel segments. TRANSCRIPTION_WORKERS bounds its parallelism instead.
+        async with self.scheduler.slot("openai", user_id, on_queued=on_queued):
+            texts = await asyncio.gather(*(transcribe(index, segment) for index, segment in enumerate(segments)))
+        return " ".join(text for text in texts if text)
 
     async def show_menu(self, update: Update, context: CallbackContext) -> None:
         reply_markup = InlineKeyboardMarkup(self.keyboard)
@@ -250,8 +632,51 @@ class TelegramBot:
         await update.message.reply_text('Please choose a service:', reply_markup=reply_markup)
 
     async def update_handler(self, update: Update, context: CallbackContext) -> None:
-        state = self.repository.get_user_state(update.effective_user.id)
+        with trace(f"Update {update.update_id} from user {update.effective_user.id}",
+                   slow_threshold=self.config.get("slow_update_seconds", 20)):
+            state = await self.repository.get_user_state(update.effective_user.id)
+            service = state or "none"
+            update_requests.inc(service=service)
+            started = time.perf_counter()
+
+            try:
+                if state in SERVICE_PROVIDERS and not self.service_available(state):
+                    raise ProviderUnavailableError(SERVICE_PROVIDERS[state])
+                # Handlers take a provider slot around their provider calls only, see provider_slot
+                with span(f"handler.{service}"):
+                    await self.dispatch_update(state, update, context)
+            except ProviderUnavailableError:
+                await update.message.reply_text("Sorry, this service is currently unavailable. Please choose "
+                                                "another one using /menu command!")
+            except Exception:
+                update_errors.inc(service=service)
+                raise
+            finally:
+                update_seconds.observe(time.perf_counter() - started, service=service)
+
+    def provider_slot(self, service: str, update: Update, tokens: int = 0):
+        # Admission covers the provider call alone, downloads and replies around it do not hold a slot
+        if service == "fast":
+            # Fastest answers are admitted per attempt instead, see text_reply
+            return contextlib.nullcontext()
+        return self.scheduler.slot(SERVICE_PROVIDERS[service], update.effective_user.id, tokens=tokens,
+                                   on_queued=self.queued_notice(update))
 
+    async def admitted_stream(self, service: str, update: Update, tokens: int, chunks):
+        # A streamed answer holds its slot for as long as the provider keeps sending chunks
+        async with self.provider_slot(service, update, tokens):
+            async for chunk in chunks:
+                yield chunk
+
+    def queued_notice(self, update: Update):
+        async def notify(position: int) -> None:
+            if position >= self.config.get("queue_notice_position", 3):
+                await update.message.reply_text(f"Many requests right now, yours is queued at position {position}. "
+                                                "It will start automatically, please wait!")
+
+        return notify
+
+    async def dispatch_update(self, state, update: Update, context: CallbackContext) -> None:
         if state == "gpt":
             if update.message.text:
                 await self.generate_gpt_response(update, context)
@@ -289,6 +714,11 @@ class TelegramBot:
                 await self.generate_gemini_response(update, context)
             else:
                 await update.message.reply_text("For this service, please, send only text messages!")
+        elif state == "fast":
+            if update.message.text:
+                await self.generate_fast_response(update, context)
+            else:
+                await update.message.reply_text("For this service, please, send only text messages!")
         else:
             await update.message.reply_text("Please choose service first using /menu command!")
 
@@ -297,37 +727,130 @@ class TelegramBot:
         user_id = query.from_user.id
         choice = query.data
 
-        if choice == "gpt":
+        if choice in SERVICE_PROVIDERS and not self.service_available(choice):
+            await context.bot.send_message(update.effective_chat.id,
+                                           "Sorry, this service is currently unavailable. Please choose another one!")
+        elif choice == "gpt":
             await context.bot.send_message(update.effective_chat.id,
                                            "You chose ChatGPT4-Turbo, latest OpenAI Language Model. Start typing "
                                            "requests!")
-            self.repository.set_user_state(user_id, 'gpt')
+            await self.repository.set_user_state(user_id, 'gpt')
         elif choice == "tts":
             await context.bot.send_message(update.effective_chat.id,
                                            "You chose Text to Speech from OpenAI. Start typing requests!")
-            self.repository.set_user_state(user_id, 'tts')
+            await self.repository.set_user_state(user_id, 'tts')
         elif choice == "itt":
             await context.bot.send_message(update.effective_chat.id,
                                            "You chose Image to Text from Google Vision. Start sending images!")
-            self.repository.set_user_state(user_id, 'itt')
+            await self.repository.set_user_state(user_id, 'itt')
         elif choice == "dalle":
             await context.bot.send_message(update.effective_chat.id,
                                            "You chose Image generation from OpenAI DALLE-3. Start typing "
                                            "requests!")
-            self.repository.set_user_state(user_id, 'dalle')
+            await self.repository.set_user_state(user_id, 'dalle')
         elif choice == "att":
             await context.bot.send_message(update.effective_chat.id,
                                            "You chose Audio transcribing from OpenAI. Start sending "
                                            "voice messages or audio files!")
-            self.repository.set_user_state(user_id, 'att')
+            await self.repository.set_user_state(user_id, 'att')
         elif choice == "gemini":
             await context.bot.send_message(update.effective_chat.id,
                                            "You chose Gemini Language model, just like GPT but from Google. "
                                            "Start typing requests!")
-            self.repository.set_user_state(user_id, 'gemini')
+            await self.repository.set_user_state(user_id, 'gemini')
+        elif choice == "fast":
+            await context.bot.send_message(update.effective_chat.id,
+                                           "You chose Fastest answer, your request goes to ChatGPT and Gemini "
+                                           "and the quicker one replies. Start typing requests!")
+            await self.repository.set_user_state(user_id, 'fast')
+
+    def is_admin(self, update: Update) -> bool:
+        return update.effective_user.id in self.config.get("admin_ids", set())
+
+    @staticmethod
+    def window_days(context: CallbackContext, default: int) -> int:
+        return max(1, min(int(context.args[0]), 366)) if context.args else default
+
+    async def global_stats_command(self, update: Update, context: CallbackContext) -> None:
+        if not self.is_admin(update):
+            await self.unrecognized_command(update, context)
+            return
+
+        try:
+            days = self.window_days(context, 7)
+        except ValueError:
+            await update.message.reply_text("Please provide the number of days. Example: /globalstats 30")
+            return
+
+        started = time.perf_counter()
+        stats = await self.repository.get_global_stats(days=days, top=10)
+        elapsed = (time.perf_counter() - started) * 1000
+
+        lines = [f"Requests in the last {days} days:"]
+        for service, count in stats["services"].items():
+            lines.append(f"{'-'.join(word.capitalize() for word in service.split('-'))}: {count}")
+        lines.append(f"Total: {sum(stats['services'].values())}")
+        lines.append("\nTop users:")
+        for place, (user_id, count) in enumerate(stats["top_users"], start=1):
+            lines.append(f"{place}. {user_id}: {count}")
+        lines.append(f"\nComputed in {elapsed:.0f} ms")
+        await send_long_text(update.message, "\n".join(lines))
+
+    async def export_usage_command(self, update: Update, context: CallbackContext) -> None:
+        if not self.is_admin(update):
+            await self.unrecognized_command(update, context)
+            return
+
+        try:
+            days = self.window_days(context, 30)
+        except ValueError:
+            await update.message.reply_text("Please provide the number of days. Example: /exportusage 90")
+            return
+
+        # Rows go from the database cursor to a gzipped file on disk. The upload reads that whole file
+        # into memory, so the number of rows is capped and the compressed export is all that is held.
+        max_rows = self.config.get("export_max_rows", 500_000)
+        truncated = False
+        with tempfile.TemporaryFile() as export:
+            with gzip.open(export, "wt", newline="", encoding="utf-8") as compressed:
+                writer = csv.writer(compressed)
+                writer.writerow(["day", "service", "user_id", "requests"])
+                rows = 0
+                usage = self.repository.usage_rows(days)
+                try:
+                    async for row in usage:
+                        if rows == max_rows:
+                            truncated = True
+                            break
+                        writer.writerow(row)
+                        rows += 1
+                finally:
+                    # Stopping early closes the database cursor now rather than when the generator is collected
+                    await usage.aclose()
+            export.seek(0)
+            caption = f"Only the first {max_rows} rows, ask for fewer days for the rest" if truncated else None
+            await update.message.reply_document(export, filename=f"usage_last_{days}_days.csv.gz", caption=caption)
+
+    async def profile_command(self, update: Update, context: CallbackContext) -> None:
+        if not self.is_admin(update):
+            await self.unrecognized_command(update, context)
+            return
+
+        try:
+            seconds = min(float(context.args[0]), 120) if context.args else 10
+        except ValueError:
+            await update.message.reply_text("Please provide the profiling window in seconds. Example: /profile 30")
+            return
+
+        if self.profiler.lock.locked():
+            await update.message.reply_text("A profile is already running, please wait for it to finish.")
+            return
+
+        await update.message.reply_text(f"Profiling for {seconds:g} seconds...")
+        await send_long_text(update.message, await self.profiler.profile(seconds))
 
     async def show_state_command(self, update: Update, context: CallbackContext) -> None:
-        state = self.repository.get_user_state(update.effective_user.id)
+        state = await self.repository.get_user_state(update.effective_user.id)
         modified_state = ''
 
         if state == "gpt":
@@ -342,26 +865,157 @@ class TelegramBot:
             modified_state = 'Audio transcribing'
         elif state == "gemini":
             modified_state = 'Google Gemini'
+        elif state == "fast":
+            modified_state = 'Fastest answer'
 
         await update.message.reply_text("Your current state: " +
                                         modified_state)
 
+    def register_metrics(self) -> None:
+        registry.gauge("scheduler_queue_depth", "Requests waiting for a provider slot", lambda: {
+            (("provider", name),): provider.queue_depth() for name, provider in self.scheduler.providers.items()
+        })
+        registry.gauge("scheduler_active", "Requests holding a provider slot", lambda: {
+            (("provider", name),): provider.active for name, provider in self.scheduler.providers.items()
+        })
+        registry.gauge("cache_hit_ratio", "Hit ratio of the user and response caches", lambda: {
+            (("cache", "user"),): self.repository.cache_stats()["hit_rate"],
+            (("cache", "response"),): self.response_cache.stats()["hit_rate"],
+        })
+        registry.gauge("cache_entries", "Entries held by in-process caches", lambda: {
+            (("cache", "user"),): self.repository.cache_stats()["size"],
+            (("cache", "response"),): len(self.response_cache.entries),
+            (("cache", "ocr"),): len(self.ocr_cache),
+        })
+        registry.gauge("response_cache_saved_seconds", "Provider latency saved by the response cache",
+                       lambda: {(): self.response_cache.saved_seconds})
+        registry.gauge("http_pool_connections", "Pooled HTTP connections by client and state", lambda: {
+            (("client", client), ("state", state)): count
+            for client, usage in self.pool_usage().items() for state, count in usage.items()
+        })
+        if self.jobs is not None:
+            registry.gauge("jobs_processed", "Background jobs by outcome", lambda: {
+                (("outcome", outcome),): count for outcome, count in self.jobs.stats().items()
+            })
+        registry.gauge("hedge_rate", "Share of fastest answer requests that sent a hedge request",
+                       lambda: {(): self.hedged_client.stats()["hedge_rate"]} if self.hedged_client else {})
+        registry.gauge("hedge_p99_first_token_seconds", "p99 first token latency of fastest answers and of "
+                                                         "their primary provider alone", lambda: {
+            (("path", path),): value for path, value in (
+                ("delivered", self.hedged_client.stats()["p99_first_token"]),
+                ("primary_only", self.hedged_client.stats()["p99_primary_only"]),
+            ) if value is not None
+        } if self.hedged_client else {})
+        if self.memory:
+            registry.gauge("conversation_sessions", "Conversations held in memory",
+                           lambda: {(): len(self.memory.sessions)})
+
+    @staticmethod
+    def metrics_route() -> tuple[str, bytes]:
+        return "text/plain; version=0.0.4", registry.render().encode()
+
     async def post_init(self, application: Application) -> None:
+        self.application = application
+        await load_token_counters(self.config.get("tokenizer_load_timeout", 10.0))
+        await self.repository.init()
         await application.bot.set_my_commands(self.commands)
+        if self.jobs is not None:
+            await self.jobs.start()
+        await self.warm_up_connections(application)
+        # OpenAI is built and warmed in the background, startup does not wait for its import and handshakes
+        if self.providers.is_available("openai"):
+            self.provider_warm_up = asyncio.create_task(self.warm_up_provider("openai"))
+        # In webhook mode /metrics is served by the webhook server instead
+        if self.config.get("metrics_port") and self.config.get("mode", "polling") != "webhook":
+            self.metrics_server = WebhookServer(application, listen=self.config.get("metrics_listen", "0.0.0.0"),
+                                                port=self.config["metrics_port"], path=None, workers=0)
+            self.metrics_server.get_routes["/metrics"] = self.metrics_route
+            await self.metrics_server.start()
 
-    def run(self):
+    async def warm_up_connections(self, application: Application) -> None:
+        warm = self.config.get("telegram_pool", {}).get("warm_connections", 4)
+        tasks = [application.bot.get_me() for _ in range(warm)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for error in results:
+            if isinstance(error, Exception):
+                logger.warning(f"Connection warm-up failed: {error!r}")
+        logger.info(f"Warmed up connections in {time.perf_counter() - started:.2f} s")
+
+    async def warm_up_provider(self, name: str) -> None:
+        try:
+            client = self.providers.get(name)
+            started = time.perf_counter()
+            await client.warm_up()
+        except ProviderUnavailableError:
+            return
+        except Exception as e:
+            logger.warning(f"Connection warm-up of {name} failed: {e!r}")
+            return
+        logger.info(f"Warmed up {name} connections in {time.perf_counter() - started:.2f} s")
+
+    def pool_usage(self) -> dict:
+        usage = {}
+        telegram_request = getattr(self.application.bot, "request", None) if self.application else None
+        telegram_usage = pool_usage(getattr(telegram_request, "_client", None))
+        if telegram_usage:
+            usage["telegram"] = telegram_usage
+        openai_client = self.providers.instances.get("openai")
+        if openai_client is not None and openai_client.pool_usage():
+            usage["openai"] = openai_client.pool_usage()
+        return usage
+
+    async def post_shutdown(self, application: Application) -> None:
+        if self.provider_warm_up is not None:
+            self.provider_warm_up.cancel()
+            await asyncio.gather(self.provider_warm_up, return_exceptions=True)
+        if self.jobs is not None:
+            logger.info(f"Job queue stats: {self.jobs.stats()}")
+            await self.jobs.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await self.repository.close()
+        if "openai" in self.providers.instances:
+            await self.openai_client.close()
+        logger.info(f"Response cache stats: {self.response_cache.stats()}")
+        logger.info(f"Scheduler stats: {self.scheduler.stats()}")
+        if self.hedged_client is not None:
+            logger.info(f"Fastest answer stats: {self.hedged_client.stats()}")
+        if self.memory:
+            logger.info(f"Conversation memory stats: {self.memory.stats()}")
+        self.response_cache.close()
+
+    def build_application(self) -> Application:
+        pool = self.config.get("telegram_pool", {})
+        http_version = "2" if pool.get("http2") and http2_supported("telegram") else "1.1"
         application = (
             Application.builder()
             .token(self.config["token"])
+            .concurrent_updates(self.config.get("concurrent_updates", True))
+            # Replies and edits share this pool, long polling has its own single connection
+            .connection_pool_size(pool.get("size", 256))
+            .pool_timeout(pool.get("pool_timeout", 5.0))
+            .connect_timeout(pool.get("connect_timeout", 5.0))
+            .read_timeout(pool.get("read_timeout", 10.0))
+            .write_timeout(pool.get("write_timeout", 30.0))
+            .http_version(http_version)
             .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
             .build()
         )
+        self.add_handlers(application)
+        return application
 
+    def add_handlers(self, application: Application) -> None:
         application.add_handler(CommandHandler("start", self.start))
         application.add_handler(CommandHandler("stats", self.stats_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("state", self.show_state_command))
         application.add_handler(CommandHandler("menu", self.show_menu))
+        application.add_handler(CommandHandler("reset", self.reset_command))
+        application.add_handler(CommandHandler("profile", self.profile_command))
+        application.add_handler(CommandHandler("globalstats", self.global_stats_command))
+        application.add_handler(CommandHandler("exportusage", self.export_usage_command))
         application.add_handler(
             MessageHandler(filters.COMMAND, self.unrecognized_command)
         )
@@ -371,4 +1025,42 @@ class TelegramBot:
                                                self.update_handler))
         application.add_handler(CallbackQueryHandler(self.keyboard_handler))
 
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    def run(self):
+        application = self.build_application()
+
+        if self.config.get("mode", "polling") == "webhook":
+            asyncio.run(self.run_webhook(application))
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+    async def run_webhook(self, application: Application) -> None:
+        server = WebhookServer(
+            application,
+            listen=self.config.get("webhook_listen", "0.0.0.0"),
+            port=self.config.get("webhook_port", 8080),
+            path=self.config.get("webhook_path", "/telegram"),
+            secret_token=self.config.get("webhook_secret"),
+            workers=self.config.get("webhook_workers", 32),
+        )
+        server.get_routes["/metrics"] = self.metrics_route
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stop_signal, stop_event.set)
+
+        # run_polling calls post_init and post_shutdown itself, here the lifecycle is driven by hand
+        async with application:
+            await self.post_init(application)
+            await application.start()
+            await server.start()
+            await application.bot.set_webhook(
+                url=self.config["webhook_url"],
+                secret_token=self.config.get("webhook_secret"),
+                allowed_updates=Update.ALL_TYPES,
+            )
+
+            await stop_event.wait()
+
+            await server.stop()
+            await application.stop()
+            await self.post_shutdown(application)
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import logging
+from http import HTTPStatus
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookServer:
+    def __init__(self, application, listen: str = "0.0.0.0", port: int = 8080, path: str = "/telegram",
+                 secret_token: str = None, workers: int = 32, queue_size: int = 1000):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.server = None
+        self.worker_tasks = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        # Extra GET endpoints, each returning a (content type, body) pair
+        self.get_routes = {"/healthz": self.health}
+
+    async def start(self) -> None:
+        self.worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Webhook server listening on {self.listen}:{self.port}{self.path} with {self.workers} workers")
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        # Finish updates that were already accepted before stopping the workers
+        await self.queue.join()
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+
+    def health(self) -> tuple[str, bytes]:
+        status = {
+            "status": "ok",
+            "queue_depth": self.queue.qsize(),
+            "workers": self.workers,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+        return "application/json", json.dumps(status).encode()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode("latin-1").split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, content_type, payload = await self._route(method, target.split("?", 1)[0], headers, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, path: str, headers: dict, body: bytes):
+        if method == "GET" and path in self.get_routes:
+            content_type, payload = self.get_routes[path]()
+            return HTTPStatus.OK, content_type, payload
+
+        if method != "POST" or path != self.path:
+            return HTTPStatus.NOT_FOUND, "text/plain", b"Not found"
+        if self.secret_token and headers.get("x-telegram-bot-api-secret-token") != self.secret_token:
+            return HTTPStatus.FORBIDDEN, "text/plain", b"Forbidden"
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, "text/plain", b"Invalid JSON"
+
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # Telegram retries the delivery later when the webhook does not answer with 200
+            return HTTPStatus.SERVICE_UNAVAILABLE, "text/plain", b"Busy"
+
+        self.received += 1
+        return HTTPStatus.OK, "text/plain", b"OK"
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: HTTPStatus, content_type: str = "text/plain",
+                       payload: bytes = b"", keep_alive: bool = True) -> None:
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
+
+    async def _worker(self) -> None:
+        while True:
+            data = await self.queue.get()
+            try:
+                update = Update.de_json(data, self.application.bot)
+                await self.application.process_update(update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Failed to process webhook update")
+            finally:
+                self.queue.task_done()
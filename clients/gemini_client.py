@@ -1,11 +1,44 @@
+import asyncio
+from typing import AsyncIterator
+
 import google.generativeai as genai
 
+from utils.metrics import provider_call
+
 
 class GeminiClient:
-    def __init__(self, api_key):
+    def __init__(self, api_key, max_in_flight: int = 8):
         genai.configure(api_key=api_key)
         self.client = genai.GenerativeModel('gemini-pro')
+        # Limits how many generations run against the Gemini API at the same time
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+
+    @staticmethod
+    def _contents(user_input, history=None):
+        if not history:
+            return user_input
 
-    async def generate_response(self, user_input):
-        response = self.client.generate_content(user_input)
+        # Gemini only knows user and model turns, the summary is passed as an acknowledged user turn
+        contents = []
+        for role, text in history:
+            if role == "system":
+                contents.append({"role": "user", "parts": [text]})
+                contents.append({"role": "model", "parts": ["Understood."]})
+            else:
+                contents.append({"role": "model" if role == "assistant" else "user", "parts": [text]})
+        contents.append({"role": "user", "parts": [user_input]})
+        return contents
+
+    @provider_call("gemini", "chat")
+    async def generate_response(self, user_input, history=None):
+        async with self.semaphore:
+            response = await self.client.generate_content_async(self._contents(user_input, history))
         return response.text
+
+    @provider_call("gemini", "chat_stream")
+    async def stream_response(self, user_input, history=None) -> AsyncIterator[str]:
+        async with self.semaphore:
+            response = await self.client.generate_content_async(self._contents(user_input, history), stream=True)
+            async for chunk in response:
+                if chunk.parts:
+                    yield chunk.text
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import AsyncContextManager, AsyncIterator, Callable, Optional
+
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+hedged_requests = registry.counter("hedged_requests_total", "Fastest answer requests by how they were answered")
+hedged_first_token_seconds = registry.histogram("hedged_first_token_seconds",
+                                                "Time until a fastest answer request delivers its first chunk")
+
+_DONE = object()
+
+
+def percentile(samples, fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class HedgedTextClient:
+    def __init__(self, clients: list[tuple[str, object]], initial_deadline: float = 2.0, min_deadline: float = 0.5,
+                 max_deadline: float = 10.0, window: int = 200, min_samples: int = 20):
+        # clients are (provider name, client) pairs, the first one is the primary
+        self.clients = clients
+        self.initial_deadline = initial_deadline
+        self.min_deadline = min_deadline
+        self.max_deadline = max_deadline
+        self.min_samples = min_samples
+        # Recent first token latencies per provider, an attempt is hedged after the p95 of its provider's
+        self.latencies = {name: deque(maxlen=window) for name, _ in clients}
+        # What users saw, and what the primary alone would have given. Primaries cancelled by a
+        # faster hedge are recorded at the time they were cancelled, so that side is a lower bound,
+        # and requests that failed over are left out of it.
+        self.delivered = deque(maxlen=window)
+        self.primary_only = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.failovers = 0
+        self.wins = {name: 0 for name, _ in clients}
+
+    def deadline(self, name: str) -> float:
+        samples = self.latencies[name]
+        if len(samples) < self.min_samples:
+            return self.initial_deadline
+        return min(self.max_deadline, max(self.min_deadline, percentile(samples, 0.95)))
+
+    async def generate_response(self, user_input, history=None,
+                                slot: Optional[Callable[[str], AsyncContextManager]] = None) -> str:
+        return "".join([chunk async for chunk in self.stream_response(user_input, history, slot)])
+
+    async def stream_response(self, user_input, history=None,
+                              slot: Optional[Callable[[str], AsyncContextManager]] = None) -> AsyncIterator[str]:
+        # slot(provider name) admits one attempt, so hedges respect the limits of the provider they go to.
+        # Every attempt consumes its provider stream in its own task and forwards chunks here,
+        # so the loser can be cancelled without touching the winner's generator.
+        results = asyncio.Queue()
+        running = {}
+        tried = []
+        started = time.perf_counter()
+        last_launch = started
+        self.requests += 1
+
+        async def attempt(name: str, client) -> None:
+            try:
+                async with slot(name) if slot is not None else nullcontext():
+                    async for chunk in client.stream_response(user_input, history):
+                        await results.put((name, chunk))
+                await results.put((name, _DONE))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await results.put((name, e))
+
+        def launch() -> None:
+            nonlocal last_launch
+            name, client = self.clients[len(tried)]
+            tried.append(name)
+            last_launch = time.perf_counter()
+            running[name] = (asyncio.create_task(attempt(name, client)), last_launch)
+
+        launch()
+        winner = None
+        try:
+            while winner is None:
+                # Every attempt gets the deadline of its own provider before the next one is launched,
+                # after that whichever answers first wins
+                timeout = None
+                if len(tried) < len(self.clients):
+                    timeout = max(0.0, self.deadline(tried[-1]) - (time.perf_counter() - last_launch))
+                try:
+                    name, item = await asyncio.wait_for(results.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    logger.info(f"No first token from {tried[-1]} within {self.deadline(tried[-1]):.2f} s, hedging")
+                    self.hedges += 1
+                    hedged_requests.inc(outcome="hedged")
+                    launch()
+                    continue
+
+                if isinstance(item, Exception):
+                    logger.warning(f"Fastest answer attempt on {name} failed: {item!r}")
+                    running.pop(name)
+                    if running:
+                        continue
+                    if len(tried) == len(self.clients):
+                        raise item
+                    self.failovers += 1
+                    hedged_requests.inc(outcome="failover")
+                    launch()
+                    continue
+
+                winner = name
+                self._record_winner(winner, running, started)
+                for other, (task, _) in running.items():
+                    if other != winner:
+                        task.cancel()
+                if item is _DONE:
+                    return
+                yield item
+
+            while True:
+                name, item = await results.get()
+                if name != winner:
+                    continue
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for task, _ in running.values():
+                task.cancel()
+
+    def _record_winner(self, winner: str, running: dict, started: float) -> None:
+        now = time.perf_counter()
+        primary = self.clients[0][0]
+        self.wins[winner] += 1
+        self.latencies[winner].append(now - running[winner][1])
+        self.delivered.append(now - started)
+        hedged_first_token_seconds.observe(now - started)
+        if winner == primary:
+            self.primary_only.append(now - started)
+            hedged_requests.inc(outcome="primary")
+            return
+
+        hedged_requests.inc(outcome="hedge_won")
+        # A primary that was still running would have answered no sooner than now. Keeping that lower
+        # bound in its window stops the deadline from drifting down to only the fast answers.
+        if primary in running:
+            self.latencies[primary].append(now - started)
+            self.primary_only.append(now - started)
+
+    def stats(self) -> dict:
+        primary_p99 = percentile(self.primary_only, 0.99)
+        delivered_p99 = percentile(self.delivered, 0.99)
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+            "failovers": self.failovers,
+            "wins": dict(self.wins),
+            "deadline": {name: round(self.deadline(name), 3) for name, _ in self.clients},
+            "p99_first_token": delivered_p99,
+            "p99_primary_only": primary_p99,
+            "p99_improvement": primary_p99 - delivered_p99 if primary_p99 is not None else None,
+        }
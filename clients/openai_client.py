@@ -1,24 +1,69 @@
-import datetime
+import asyncio
+from typing import AsyncIterator
 
-from pathlib import Path
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
+
+from utils.http_pool import http2_supported, pool_usage
+from utils.metrics import provider_call
 
 
 class OpenAIClient:
-    def __init__(self, openai_api_key):
-        self.client = OpenAI(api_key=openai_api_key)
+    def __init__(self, openai_api_key, max_connections: int = 32, max_keepalive_connections: int = 16,
+                 keepalive_expiry: float = 60.0, http2: bool = False, connect_timeout: float = 5.0,
+                 read_timeout: float = 600.0, warm_connections: int = 2):
+        # One long lived pool, so bursts reuse warm TLS connections instead of opening new ones
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive_connections,
+                                keepalive_expiry=keepalive_expiry),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            http2=http2 and http2_supported("openai"),
+        )
+        self.client = AsyncOpenAI(api_key=openai_api_key, http_client=self.http_client)
+        self.warm_connections = min(warm_connections, max_connections)
+
+    async def warm_up(self) -> None:
+        # Listing models is free and opens the connections the first real requests will reuse
+        await asyncio.gather(*(self.client.models.list() for _ in range(self.warm_connections)))
+
+    def pool_usage(self) -> dict:
+        return pool_usage(self.http_client)
+
+    async def close(self) -> None:
+        await self.http_client.aclose()
 
-    async def generate_response(self, user_input: str) -> str:
-        response = self.client.chat.completions.create(
+    @staticmethod
+    def _messages(user_input: str, history=None) -> list[dict]:
+        messages = [{"role": role, "content": text} for role, text in history or []]
+        messages.append({"role": "user", "content": user_input})
+        return messages
+
+    @provider_call("openai", "chat")
+    async def generate_response(self, user_input: str, history=None) -> str:
+        response = await self.client.chat.completions.create(
             model="gpt-4-1106-preview",
-            messages=[{"role": "user", "content": user_input}],
+            messages=self._messages(user_input, history),
         )
 
         generated_text = response.choices[0].message.content
         return generated_text
 
+    @provider_call("openai", "chat_stream")
+    async def stream_response(self, user_input: str, history=None) -> AsyncIterator[str]:
+        stream = await self.client.chat.completions.create(
+            model="gpt-4-1106-preview",
+            messages=self._messages(user_input, history),
+            stream=True,
+        )
+
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    @provider_call("openai", "image")
     async def generate_image(self, user_input: str) -> str:
-        response = self.client.images.generate(
+        response = await self.client.images.generate(
             model="dall-e-3",
             prompt=user_input,
             size="1024x1024",
@@ -28,17 +73,18 @@ class OpenAIClient:
 
         return response.data[0].url
 
-    async def generate_speech(self, user_input) -> Path:
-        speech_file_path = Path(__file__).parent / f"speech-{datetime.time}.mp3"
-        response = self.client.audio.speech.create(
-            model="tts-1", voice="alloy", input=user_input
+    @provider_call("openai", "speech")
+    async def generate_speech(self, user_input) -> bytes:
+        # Opus in an OGG container plays as a Telegram voice note without conversion
+        response = await self.client.audio.speech.create(
+            model="tts-1", voice="alloy", input=user_input, response_format="opus"
         )
-        response.stream_to_file(speech_file_path)
 
-        return speech_file_path
+        return response.content
 
+    @provider_call("openai", "transcription")
     async def transcribe_audio(self, audio_file) -> str:
-        transcript = self.client.audio.transcriptions.create(
+        transcript = await self.client.audio.transcriptions.create(
             model="whisper-1", file=audio_file
         )
 
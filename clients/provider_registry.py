@@ -0,0 +1,50 @@
+import importlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderUnavailableError(Exception):
+    pass
+
+
+class ProviderRegistry:
+    def __init__(self):
+        self.factories = {}
+        self.instances = {}
+        self.failed = set()
+
+    def register(self, name: str, module: str, class_name: str, required: dict = None, **kwargs) -> None:
+        # required maps setting names to their values, the provider is disabled when any of them is missing
+        self.factories[name] = (module, class_name, required or {}, kwargs)
+
+    def missing_settings(self, name: str) -> list[str]:
+        _, _, required, _ = self.factories[name]
+        return [setting for setting, value in required.items() if not value]
+
+    def is_available(self, name: str) -> bool:
+        return name in self.factories and name not in self.failed and not self.missing_settings(name)
+
+    def get(self, name: str):
+        if name in self.instances:
+            return self.instances[name]
+        if not self.is_available(name):
+            raise ProviderUnavailableError(name)
+
+        module, class_name, _, kwargs = self.factories[name]
+        try:
+            provider_class = getattr(importlib.import_module(module), class_name)
+            self.instances[name] = provider_class(**kwargs)
+        except Exception as e:
+            logger.exception(f"Failed to initialize {name} provider, disabling it")
+            self.failed.add(name)
+            raise ProviderUnavailableError(name) from e
+
+        logger.info(f"Initialized {name} provider")
+        return self.instances[name]
+
+    def log_status(self) -> None:
+        for name in self.factories:
+            missing = self.missing_settings(name)
+            if missing:
+                logger.warning(f"{name} provider disabled, missing settings: {', '.join(missing)}")
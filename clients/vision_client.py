@@ -1,18 +1,51 @@
+import logging
+from typing import Optional
+
 from google.cloud import vision_v1p3beta1 as vision
 
+from utils.metrics import provider_call
+
+logger = logging.getLogger(__name__)
+
+# Vision accepts at most 16 images in one batch_annotate_images request
+MAX_BATCH_SIZE = 16
+
 
 class VisionClient:
     def __init__(self):
-        self.client = vision.ImageAnnotatorClient()
+        # The gRPC asyncio channel has to be created inside the running event loop, so it is opened on first use
+        self.client = None
+
+    async def image_to_text_client(self, content) -> Optional[str]:
+        return (await self.images_to_text([content]))[0]
+
+    @provider_call("vision", "text_detection")
+    async def images_to_text(self, contents: list[bytes]) -> list[Optional[str]]:
+        if self.client is None:
+            self.client = vision.ImageAnnotatorAsyncClient()
+
+        results = []
+        for start in range(0, len(contents), MAX_BATCH_SIZE):
+            requests = [
+                vision.AnnotateImageRequest(
+                    image=vision.Image(content=content),
+                    features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+                )
+                for content in contents[start:start + MAX_BATCH_SIZE]
+            ]
+            batch = await self.client.batch_annotate_images(requests=requests)
+            results.extend(self._response_text(response) for response in batch.responses)
 
-    async def image_to_text_client(self, content) -> str:
-        image = vision.Image(content=content)
+        return results
 
-        response = self.client.text_detection(image=image)
+    @staticmethod
+    def _response_text(response) -> Optional[str]:
         texts = response.text_annotations
 
+        # None tells the caller the image failed, so the failure is not mistaken for recognized text
         if response.error.message:
-            return "Something went wrong. We are working on it!"
+            logger.warning(f"Vision could not annotate an image: {response.error.message}")
+            return None
 
         if texts:
             return texts[0].description
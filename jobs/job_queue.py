@@ -0,0 +1,221 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying the job cannot help, the job is failed right away."""
+
+
+class Job:
+    __slots__ = ("id", "kind", "payload", "attempts", "steps")
+
+    def __init__(self, job_id: int, kind: str, payload: dict, attempts: int, steps: dict):
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        # Results of the steps finished by earlier attempts, see JobQueue.record_step
+        self.steps = steps
+
+
+JobHandler = Callable[[Job], Awaitable[None]]
+
+
+class JobQueue:
+    def __init__(self, path: str = "bot_jobs.db", workers: int = 4, max_attempts: int = 5,
+                 backoff_base: float = 2.0, backoff_max: float = 300.0, poll_interval: float = 1.0,
+                 lease_seconds: float = 60.0, permanent_errors: tuple = ()):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.permanent_errors = (PermanentJobError, *permanent_errors)
+        # Running jobs are leased to one queue instance, other processes sharing the database
+        # only take them over once the owner stopped renewing the lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.handlers: dict[str, JobHandler] = {}
+        self.failure_handlers: dict[str, JobHandler] = {}
+        self.worker_tasks = []
+        self.heartbeat_task = None
+        self.wakeup = None
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "run_at REAL NOT NULL, created_at REAL NOT NULL, last_error TEXT, "
+            "owner TEXT, lease_until REAL, steps TEXT NOT NULL DEFAULT '{}')"
+        )
+        # Databases created before leases and steps existed get the new columns added
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (("owner", "TEXT"), ("lease_until", "REAL"),
+                                   ("steps", "TEXT NOT NULL DEFAULT '{}'")):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at)")
+
+    def register(self, kind: str, handler: JobHandler, on_failure: Optional[JobHandler] = None) -> None:
+        self.handlers[kind] = handler
+        if on_failure is not None:
+            self.failure_handlers[kind] = on_failure
+
+    async def enqueue(self, kind: str, payload: dict) -> int:
+        job_id = await asyncio.to_thread(self._insert, kind, json.dumps(payload))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return job_id
+
+    async def record_step(self, job: Job, **results) -> None:
+        # Handlers store what they already did, so a retry skips provider calls and replies that succeeded
+        job.steps.update(results)
+        await asyncio.to_thread(self._execute, "UPDATE jobs SET steps = ? WHERE id = ? AND owner = ?",
+                                (json.dumps(job.steps), job.id, self.owner))
+
+    async def start(self) -> None:
+        # Jobs of a process that died keep their lease until it expires, then _claim takes them over
+        expired = await asyncio.to_thread(
+            self._scalar, "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND COALESCE(lease_until, 0) < ?",
+            (time.time(),),
+        )
+        if expired:
+            logger.info(f"Resuming {expired} unfinished jobs with expired leases")
+        self.wakeup = asyncio.Event()
+        self.worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self) -> None:
+        tasks = [*self.worker_tasks, self.heartbeat_task] if self.heartbeat_task else self.worker_tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.worker_tasks = []
+        self.heartbeat_task = None
+        # Jobs interrupted here are handed back right away instead of waiting for their lease to expire
+        await asyncio.to_thread(
+            self._execute, "UPDATE jobs SET status = 'pending', owner = NULL, lease_until = NULL "
+                           "WHERE status = 'running' AND owner = ?", (self.owner,),
+        )
+        self.connection.close()
+
+    async def pending_count(self) -> int:
+        return await asyncio.to_thread(self._scalar, "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')")
+
+    def stats(self) -> dict:
+        return {"completed": self.completed, "retried": self.retried, "failed": self.failed}
+
+    async def _worker(self) -> None:
+        while True:
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                self.wakeup.clear()
+                next_run_at = await asyncio.to_thread(
+                    self._scalar, "SELECT MIN(run_at) FROM jobs WHERE status = 'pending'"
+                )
+                timeout = self.poll_interval if next_run_at is None else max(0.0, next_run_at - time.time())
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(timeout, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run(job)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(
+                    self._execute, "UPDATE jobs SET lease_until = ? WHERE status = 'running' AND owner = ?",
+                    (time.time() + self.lease_seconds, self.owner),
+                )
+            except sqlite3.Error:
+                logger.exception("Could not renew job leases")
+
+    async def _run(self, job: Job) -> None:
+        handler = self.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for {job.kind} jobs")
+            await handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if job.attempts < self.max_attempts and not isinstance(e, self.permanent_errors):
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (job.attempts - 1))
+                logger.warning(f"Job {job.id} ({job.kind}) failed on attempt {job.attempts}, retrying in {delay:g} s")
+                self.retried += 1
+                await asyncio.to_thread(
+                    self._execute, "UPDATE jobs SET status = 'pending', run_at = ?, last_error = ?, owner = NULL, "
+                                   "lease_until = NULL WHERE id = ?",
+                    (time.time() + delay, repr(e), job.id),
+                )
+                return
+
+            if isinstance(e, self.permanent_errors):
+                logger.error(f"Job {job.id} ({job.kind}) failed permanently on attempt {job.attempts}: {e!r}")
+            else:
+                logger.exception(f"Job {job.id} ({job.kind}) failed after {job.attempts} attempts")
+            self.failed += 1
+            await asyncio.to_thread(
+                self._execute, "UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?", (repr(e), job.id)
+            )
+            on_failure = self.failure_handlers.get(job.kind)
+            if on_failure is not None:
+                try:
+                    await on_failure(job)
+                except Exception:
+                    logger.exception(f"Failure handler of job {job.id} ({job.kind}) raised")
+            return
+
+        self.completed += 1
+        await asyncio.to_thread(self._execute, "DELETE FROM jobs WHERE id = ?", (job.id,))
+
+    def _insert(self, kind: str, payload: str) -> int:
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (kind, payload, run_at, created_at) VALUES (?, ?, ?, ?)", (kind, payload, now, now)
+            )
+            return cursor.lastrowid
+
+    def _claim(self) -> Optional[Job]:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, owner = ?, lease_until = ? WHERE id = ("
+                "SELECT id FROM jobs WHERE (status = 'pending' AND run_at <= ?) "
+                "OR (status = 'running' AND COALESCE(lease_until, 0) < ?) ORDER BY run_at, id LIMIT 1"
+                ") RETURNING id, kind, payload, attempts, steps",
+                (self.owner, now + self.lease_seconds, now, now),
+            ).fetchone()
+        if row is None:
+            return None
+        return Job(row[0], row[1], json.loads(row[2]), row[3], json.loads(row[4]))
+
+    def _execute(self, statement: str, parameters: tuple = ()) -> int:
+        with self.lock:
+            return self.connection.execute(statement, parameters).rowcount
+
+    def _scalar(self, statement: str, parameters: tuple = ()):
+        with self.lock:
+            return self.connection.execute(statement, parameters).fetchone()[0]
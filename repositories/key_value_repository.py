@@ -0,0 +1,138 @@
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from repositories.request_counter import CounterBatch, RequestCounter, usage_day
+from repositories.user_cache import UserCache
+from utils.metrics import db_operation
+
+
+class KeyValueUserRepository:
+    def __init__(self, client, key_prefix: str = "bot:", counter_flush_interval: float = 5.0,
+                 counter_flush_threshold: int = 500, user_cache_size: int = 10000, user_cache_ttl: float = 600):
+        # client is a redis.asyncio.Redis created with decode_responses=True, or an InMemoryKeyValueStore
+        self.client = client
+        self.key_prefix = key_prefix
+        self.request_counter = RequestCounter(
+            self._write_request_counts, flush_interval=counter_flush_interval, flush_threshold=counter_flush_threshold
+        )
+        # Other processes may change a user's state, so only the existence of users is cached here
+        self.user_cache = UserCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+
+    def _user_key(self, user_id) -> str:
+        return f"{self.key_prefix}user:{user_id}"
+
+    def _requests_key(self, user_id) -> str:
+        return f"{self.key_prefix}requests:{user_id}"
+
+    # Daily rollups: requests per service, per user, and per user and service for exports
+    def _usage_key(self, day) -> str:
+        return f"{self.key_prefix}usage:{day}"
+
+    def _usage_users_key(self, day) -> str:
+        return f"{self.key_prefix}usage_users:{day}"
+
+    def _usage_detail_key(self, day) -> str:
+        return f"{self.key_prefix}usage_detail:{day}"
+
+    @staticmethod
+    def _window_days(days: int) -> list[str]:
+        today = datetime.now(timezone.utc)
+        return [usage_day(today - timedelta(days=offset)) for offset in range(days)]
+
+    async def init(self):
+        await self.request_counter.start()
+
+    async def close(self):
+        await self.request_counter.stop()
+        await self.client.aclose()
+
+    @db_operation("key_value", "insert_user")
+    async def insert_user(self, user_id, username, first_name, last_name):
+        await self.client.hset(self._user_key(user_id), mapping={
+            "username": username or "",
+            "first_name": first_name or "",
+            "last_name": last_name or "",
+        })
+        self.user_cache.set_state(user_id, None)
+
+    async def update_request_count(self, user_id, service_name, amount=1):
+        self.request_counter.increment(user_id, service_name, amount)
+
+    @db_operation("key_value", "write_request_counts")
+    async def _write_request_counts(self, batch: CounterBatch):
+        # HINCRBY is atomic, so several processes can flush counters for the same user without lost updates
+        totals = defaultdict(int)
+        for (user_id, service_name, _), count in batch.items():
+            totals[(user_id, service_name)] += count
+
+        async with self.client.pipeline(transaction=True) as pipeline:
+            for (user_id, service_name), count in totals.items():
+                pipeline.hincrby(self._requests_key(user_id), service_name, count)
+            for (user_id, service_name, day), count in batch.items():
+                pipeline.hincrby(self._usage_key(day), service_name, count)
+                pipeline.zincrby(self._usage_users_key(day), count, user_id)
+                pipeline.hincrby(self._usage_detail_key(day), f"{service_name}:{user_id}", count)
+            await pipeline.execute()
+
+    @db_operation("key_value", "set_user_state")
+    async def set_user_state(self, user_id, state):
+        if await self.user_exists(user_id):
+            await self.client.hset(self._user_key(user_id), "state", state or "")
+
+    @db_operation("key_value", "get_user_state")
+    async def get_user_state(self, user_id):
+        return await self.client.hget(self._user_key(user_id), "state") or None
+
+    async def get_service_counts(self, user_id):
+        return await self.request_counter.merged_counts(user_id, self._load_service_counts)
+
+    @db_operation("key_value", "load_service_counts")
+    async def _load_service_counts(self, user_id):
+        counts = await self.client.hgetall(self._requests_key(user_id))
+        return {service: int(count) for service, count in counts.items()}
+
+    async def get_global_stats(self, days: int = 7, top: int = 10) -> dict:
+        await self.request_counter.flush()
+        return await self._load_global_stats(self._window_days(days), top)
+
+    @db_operation("key_value", "load_global_stats")
+    async def _load_global_stats(self, days: list[str], top: int) -> dict:
+        services = defaultdict(int)
+        async with self.client.pipeline(transaction=False) as pipeline:
+            for day in days:
+                pipeline.hgetall(self._usage_key(day))
+            for counts in await pipeline.execute():
+                for service, count in counts.items():
+                    services[service] += int(count)
+
+        # Per-day user rankings are merged server side, only the top entries come back
+        union_key = f"{self.key_prefix}usage_users_window:{uuid.uuid4().hex}"
+        async with self.client.pipeline(transaction=False) as pipeline:
+            pipeline.zunionstore(union_key, [self._usage_users_key(day) for day in days])
+            pipeline.zrevrange(union_key, 0, top - 1, withscores=True)
+            pipeline.delete(union_key)
+            _, top_users, _ = await pipeline.execute()
+
+        return {
+            "services": dict(sorted(services.items(), key=lambda item: -item[1])),
+            "top_users": [(int(user_id), int(count)) for user_id, count in top_users],
+        }
+
+    async def usage_rows(self, days: int = 30):
+        await self.request_counter.flush()
+        for day in sorted(self._window_days(days)):
+            async for field, count in self.client.hscan_iter(self._usage_detail_key(day), count=1000):
+                service_name, user_id = field.rsplit(":", 1)
+                yield day, service_name, int(user_id), int(count)
+
+    async def user_exists(self, user_id):
+        if self.user_cache.contains(user_id):
+            return True
+        if await self.client.exists(self._user_key(user_id)):
+            self.user_cache.set_state(user_id, None)
+            return True
+        return False
+
+    def cache_stats(self) -> dict:
+        return self.user_cache.stats()
@@ -0,0 +1,85 @@
+class InMemoryKeyValueStore:
+    # Stand-in for the subset of the redis.asyncio client used by KeyValueUserRepository, for a single process
+
+    def __init__(self):
+        self.data: dict[str, dict[str, str]] = {}
+        self.sorted_sets: dict[str, dict[str, float]] = {}
+
+    async def exists(self, *names) -> int:
+        return sum(1 for name in names if name in self.data or name in self.sorted_sets)
+
+    async def delete(self, *names) -> int:
+        return sum(1 for name in names
+                   if self.data.pop(name, None) is not None or self.sorted_sets.pop(name, None) is not None)
+
+    async def hset(self, name, key=None, value=None, mapping=None) -> int:
+        values = dict(mapping or {})
+        if key is not None:
+            values[key] = value
+        fields = self.data.setdefault(name, {})
+        added = sum(1 for field in values if field not in fields)
+        fields.update({field: str(field_value) for field, field_value in values.items()})
+        return added
+
+    async def hget(self, name, key):
+        return self.data.get(name, {}).get(key)
+
+    async def hgetall(self, name) -> dict:
+        return dict(self.data.get(name, {}))
+
+    async def hincrby(self, name, key, amount=1) -> int:
+        fields = self.data.setdefault(name, {})
+        fields[key] = str(int(fields.get(key, 0)) + amount)
+        return int(fields[key])
+
+    async def hscan_iter(self, name, match=None, count=None):
+        for key, value in list(self.data.get(name, {}).items()):
+            yield key, value
+
+    async def zincrby(self, name, amount, value) -> float:
+        members = self.sorted_sets.setdefault(name, {})
+        members[str(value)] = members.get(str(value), 0.0) + amount
+        return members[str(value)]
+
+    async def zunionstore(self, dest, keys) -> int:
+        union = {}
+        for key in keys:
+            for member, score in self.sorted_sets.get(key, {}).items():
+                union[member] = union.get(member, 0.0) + score
+        self.sorted_sets[dest] = union
+        return len(union)
+
+    async def zrevrange(self, name, start, end, withscores=False) -> list:
+        ranked = sorted(self.sorted_sets.get(name, {}).items(), key=lambda item: -item[1])
+        ranked = ranked[start:None if end == -1 else end + 1]
+        return ranked if withscores else [member for member, _ in ranked]
+
+    def pipeline(self, transaction=True):
+        return InMemoryPipeline(self)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class InMemoryPipeline:
+    def __init__(self, store: InMemoryKeyValueStore):
+        self.store = store
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self) -> list:
+        results = [await getattr(self.store, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.commands = []
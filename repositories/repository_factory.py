@@ -0,0 +1,36 @@
+from repositories.user_repository import DEFAULT_DATABASE_URL
+
+
+def create_user_repository(config: dict):
+    backend = config.get("state_backend", "sql")
+    options = {
+        "counter_flush_interval": config.get("counter_flush_interval", 5.0),
+        "counter_flush_threshold": config.get("counter_flush_threshold", 500),
+        "user_cache_size": config.get("user_cache_size", 10000),
+        "user_cache_ttl": config.get("user_cache_ttl", 600),
+    }
+
+    if backend == "sql":
+        from repositories.user_repository import UserRepository
+
+        return UserRepository(
+            config.get("database_url", DEFAULT_DATABASE_URL), pool_size=config.get("database_pool_size", 5), **options
+        )
+
+    from repositories.key_value_repository import KeyValueUserRepository
+
+    if backend == "redis":
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("The redis state backend needs the redis package, pip install redis") from e
+
+        client = redis.from_url(config.get("redis_url", "redis://localhost:6379/0"), decode_responses=True)
+    elif backend == "memory":
+        from repositories.memory_store import InMemoryKeyValueStore
+
+        client = InMemoryKeyValueStore()
+    else:
+        raise ValueError(f"Unknown state backend: {backend}")
+
+    return KeyValueUserRepository(client, key_prefix=config.get("redis_key_prefix", "bot:"), **options)
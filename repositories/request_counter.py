@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# Keyed by user id, service name and the UTC day the requests completed on
+CounterBatch = dict[tuple[int, str, str], int]
+
+
+def usage_day(moment: datetime = None) -> str:
+    return (moment or datetime.now(timezone.utc)).date().isoformat()
+
+
+class RequestCounter:
+    def __init__(self, flush_callback: Callable[[CounterBatch], Awaitable[None]], flush_interval: float = 5.0,
+                 flush_threshold: int = 500):
+        self.flush_callback = flush_callback
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.pending: CounterBatch = defaultdict(int)
+        self.lock = asyncio.Lock()
+        self._periodic_task = None
+        self._threshold_task = None
+
+    def increment(self, user_id: int, service_name: str, amount: int = 1) -> None:
+        self.pending[(user_id, service_name, usage_day())] += amount
+        if len(self.pending) >= self.flush_threshold and (self._threshold_task is None or self._threshold_task.done()):
+            self._threshold_task = asyncio.create_task(self.flush())
+
+    def pending_counts(self, user_id: int) -> dict[str, int]:
+        counts = defaultdict(int)
+        for (pending_user_id, service, _), count in self.pending.items():
+            if pending_user_id == user_id:
+                counts[service] += count
+        return dict(counts)
+
+    async def merged_counts(self, user_id: int, load: Callable[[int], Awaitable[dict[str, int]]]) -> dict[str, int]:
+        # Holding the lock guarantees no batch is half-way between memory and storage while reading
+        async with self.lock:
+            counts = await load(user_id)
+            for service, count in self.pending_counts(user_id).items():
+                counts[service] = counts.get(service, 0) + count
+        return counts
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, defaultdict(int)
+            try:
+                await self.flush_callback(batch)
+            except Exception:
+                logger.exception(f"Failed to flush {len(batch)} request counters, keeping them for the next flush")
+                for key, count in batch.items():
+                    self.pending[key] += count
+
+    async def start(self) -> None:
+        if self._periodic_task is None:
+            self._periodic_task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        if self._periodic_task is not None:
+            self._periodic_task.cancel()
+            try:
+                await self._periodic_task
+            except asyncio.CancelledError:
+                pass
+            self._periodic_task = None
+        await self.flush()
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
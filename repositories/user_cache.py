@@ -0,0 +1,34 @@
+from cachetools import TTLCache
+
+
+class UserCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 600):
+        # Maps user_id to the user's current service state, None when no service is chosen yet
+        self.states = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, user_id) -> bool:
+        if user_id in self.states:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def get_state(self, user_id):
+        return self.states.get(user_id)
+
+    def set_state(self, user_id, state) -> None:
+        self.states[user_id] = state
+
+    def invalidate(self, user_id) -> None:
+        self.states.pop(user_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.states),
+        }
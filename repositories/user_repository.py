@@ -1,69 +1,206 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 
-from user.user import User, Request
+from sqlalchemy import event, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from repositories.request_counter import CounterBatch, RequestCounter, usage_day
+from repositories.user_cache import UserCache
+from user.user import Base, User, Request, ServiceUsageDaily, UsageRollup
+from utils.metrics import db_operation
+
+DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///bot_database.db"
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": "5000",
+    "temp_store": "MEMORY",
+    "cache_size": "-16000",
+}
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def window_start(days: int) -> str:
+    # The window covers today and the days - 1 days before it
+    return usage_day(datetime.now(timezone.utc) - timedelta(days=days - 1))
 
 
 class UserRepository:
-    def __init__(self):
-        self.Base = declarative_base()
-        self.engine = create_engine("sqlite:///bot_database.db", echo=False)
-        self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
+    def __init__(self, database_url: str = DEFAULT_DATABASE_URL, pool_size: int = 5, max_overflow: int = 10,
+                 counter_flush_interval: float = 5.0, counter_flush_threshold: int = 500,
+                 user_cache_size: int = 10000, user_cache_ttl: float = 600):
+        # In-memory SQLite uses a single static connection, so pool sizing does not apply
+        pool_options = {} if ":memory:" in database_url else {
+            "pool_size": pool_size, "max_overflow": max_overflow, "pool_pre_ping": True
+        }
+        self.engine = create_async_engine(database_url, echo=False, **pool_options)
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine.sync_engine, "connect", _set_sqlite_pragmas)
+        self.Session = async_sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.request_counter = RequestCounter(
+            self._write_request_counts, flush_interval=counter_flush_interval, flush_threshold=counter_flush_threshold
+        )
+        self.user_cache = UserCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+
+    async def init(self):
+        async with self.engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        await self.request_counter.start()
 
-    def insert_user(self, user_id, username, first_name, last_name):
+    async def close(self):
+        await self.request_counter.stop()
+        await self.engine.dispose()
+
+    @db_operation("sql", "insert_user")
+    async def insert_user(self, user_id, username, first_name, last_name):
         user = User(
             user_id=user_id,
             username=username,
             first_name=first_name,
             last_name=last_name,
         )
-        self.session.merge(user)
-        self.session.commit()
-
-    def update_request_count(self, user_id, service_name):
-        request = (
-            self.session.query(Request)
-            .filter_by(user_id=user_id, service_name=service_name)
-            .first()
-        )
-        if request:
-            request.request_count += 1
-        else:
-            request = Request(
-                user_id=user_id, service_name=service_name, request_count=1
+        async with self.Session() as session:
+            await session.merge(user)
+            await session.commit()
+        self.user_cache.set_state(user_id, None)
+
+    async def update_request_count(self, user_id, service_name, amount=1):
+        self.request_counter.increment(user_id, service_name, amount)
+
+    @db_operation("sql", "write_request_counts")
+    async def _write_request_counts(self, batch: CounterBatch):
+        totals = defaultdict(int)
+        services = defaultdict(int)
+        for (user_id, service_name, day), count in batch.items():
+            totals[(user_id, service_name)] += count
+            services[(day, service_name)] += count
+
+        # Totals and both rollups change in the same transaction, so they always agree
+        async with self.Session() as session:
+            await self._increment(session, Request, [
+                {"user_id": user_id, "service_name": service_name, "request_count": count}
+                for (user_id, service_name), count in totals.items()
+            ])
+            await self._increment(session, UsageRollup, [
+                {"day": day, "service_name": service_name, "user_id": user_id, "request_count": count}
+                for (user_id, service_name, day), count in batch.items()
+            ])
+            await self._increment(session, ServiceUsageDaily, [
+                {"day": day, "service_name": service_name, "request_count": count}
+                for (day, service_name), count in services.items()
+            ])
+            await session.commit()
+
+    async def _increment(self, session: AsyncSession, model, rows: list[dict]):
+        # Adds request_count of every row to the stored row with the same primary key
+        dialect = self.engine.dialect.name
+        keys = [column.name for column in model.__table__.primary_key]
+
+        if dialect in ("sqlite", "postgresql"):
+            insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+            statement = insert(model).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=keys,
+                set_={"request_count": model.request_count + statement.excluded.request_count},
             )
-            self.session.merge(request)
-        self.session.commit()
+            await session.execute(statement)
+        else:
+            for row in rows:
+                stored = await session.get(model, tuple(row[key] for key in keys))
+                if stored:
+                    stored.request_count += row["request_count"]
+                else:
+                    session.add(model(**row))
 
-    def set_user_state(self, user_id, state):
-        request = (
-            self.session.query(User)
-            .filter_by(user_id=user_id).first()
-        )
-        if request:
-            request.state = state
-            self.session.commit()
-
-    def get_user_state(self, user_id):
-        request = (
-            self.session.query(User)
-            .filter_by(user_id=user_id).first()
-        )
-        if request:
-            return request.state
-
-    def get_service_counts(self, user_id):
-        result = (
-            self.session.query(Request.service_name, Request.request_count)
-            .filter_by(user_id=user_id)
-            .all()
-        )
-        service_counts = {service: count for service, count in result}
+    @db_operation("sql", "set_user_state")
+    async def set_user_state(self, user_id, state):
+        async with self.Session() as session:
+            result = await session.execute(update(User).where(User.user_id == user_id).values(state=state))
+            await session.commit()
+        if result.rowcount:
+            self.user_cache.set_state(user_id, state)
+
+    async def get_user_state(self, user_id):
+        if self.user_cache.contains(user_id):
+            return self.user_cache.get_state(user_id)
+
+        await self._load_user(user_id)
+        return self.user_cache.get_state(user_id)
+
+    @db_operation("sql", "load_user")
+    async def _load_user(self, user_id) -> bool:
+        async with self.Session() as session:
+            row = (await session.execute(select(User.user_id, User.state).where(User.user_id == user_id))).first()
+        if row is None:
+            return False
+
+        self.user_cache.set_state(user_id, row.state)
+        return True
+
+    async def get_service_counts(self, user_id):
+        return await self.request_counter.merged_counts(user_id, self._load_service_counts)
+
+    @db_operation("sql", "load_service_counts")
+    async def _load_service_counts(self, user_id):
+        async with self.Session() as session:
+            result = await session.execute(
+                select(Request.service_name, Request.request_count).where(Request.user_id == user_id)
+            )
+            service_counts = {service: count for service, count in result.all()}
 
         return service_counts
 
-    def user_exists(self, user_id):
-        user = self.session.query(User).filter_by(user_id=user_id).first()
-        return user is not None
+    async def get_global_stats(self, days: int = 7, top: int = 10) -> dict:
+        # Counters still waiting for a flush are included, so the numbers match what users were served
+        await self.request_counter.flush()
+        return await self._load_global_stats(window_start(days), top)
+
+    @db_operation("sql", "load_global_stats")
+    async def _load_global_stats(self, since: str, top: int) -> dict:
+        async with self.Session() as session:
+            services = await session.execute(
+                select(ServiceUsageDaily.service_name, func.sum(ServiceUsageDaily.request_count))
+                .where(ServiceUsageDaily.day >= since)
+                .group_by(ServiceUsageDaily.service_name)
+            )
+            total = func.sum(UsageRollup.request_count).label("total")
+            top_users = await session.execute(
+                select(UsageRollup.user_id, total)
+                .where(UsageRollup.day >= since)
+                .group_by(UsageRollup.user_id)
+                .order_by(total.desc())
+                .limit(top)
+            )
+            return {
+                "services": dict(sorted(services.all(), key=lambda row: -row[1])),
+                "top_users": [(user_id, count) for user_id, count in top_users.all()],
+            }
+
+    async def usage_rows(self, days: int = 30):
+        # Yields (day, service, user id, count) rows a batch at a time instead of loading the whole table
+        await self.request_counter.flush()
+        async with self.Session() as session:
+            result = await session.stream(
+                select(UsageRollup.day, UsageRollup.service_name, UsageRollup.user_id, UsageRollup.request_count)
+                .where(UsageRollup.day >= window_start(days))
+                .order_by(UsageRollup.day, UsageRollup.service_name, UsageRollup.user_id)
+                .execution_options(yield_per=1000)
+            )
+            async for row in result:
+                yield tuple(row)
+
+    async def user_exists(self, user_id):
+        if self.user_cache.contains(user_id):
+            return True
+        return await self._load_user(user_id)
+
+    def cache_stats(self) -> dict:
+        return self.user_cache.stats()
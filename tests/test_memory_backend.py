@@ -0,0 +1,63 @@
+import asyncio
+
+from repositories.repository_factory import create_user_repository
+
+
+def run_with_repository(scenario):
+    async def main():
+        repository = create_user_repository({"state_backend": "memory", "counter_flush_interval": 60})
+        await repository.init()
+        try:
+            return await scenario(repository)
+        finally:
+            await repository.close()
+
+    return asyncio.run(main())
+
+
+def test_user_exists_after_insert():
+    async def scenario(repository):
+        assert not await repository.user_exists(1)
+        await repository.insert_user(1, "alice", "Alice", None)
+        assert await repository.user_exists(1)
+        assert not await repository.user_exists(2)
+
+    run_with_repository(scenario)
+
+
+def test_state_is_kept_for_known_users_only():
+    async def scenario(repository):
+        await repository.insert_user(1, "alice", "Alice", None)
+        assert await repository.get_user_state(1) is None
+
+        await repository.set_user_state(1, "gpt")
+        assert await repository.get_user_state(1) == "gpt"
+        await repository.set_user_state(1, None)
+        assert await repository.get_user_state(1) is None
+
+        await repository.set_user_state(2, "gpt")
+        assert await repository.get_user_state(2) is None
+
+    run_with_repository(scenario)
+
+
+def test_request_counts_before_and_after_flush():
+    async def scenario(repository):
+        await repository.insert_user(1, "alice", "Alice", None)
+        await repository.update_request_count(1, "chat-gpt")
+        await repository.update_request_count(1, "chat-gpt")
+        await repository.update_request_count(1, "image-generation", amount=3)
+
+        # Pending increments are merged into the counts before they are written
+        expected = {"chat-gpt": 2, "image-generation": 3}
+        assert await repository.get_service_counts(1) == expected
+
+        await repository.request_counter.flush()
+        assert await repository.get_service_counts(1) == expected
+        assert await repository.get_service_counts(2) == {}
+
+        stats = await repository.get_global_stats(days=1)
+        assert stats["services"] == {"image-generation": 3, "chat-gpt": 2}
+        assert stats["top_users"] == [(1, 5)]
+
+    run_with_repository(scenario)
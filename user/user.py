@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -20,3 +20,26 @@ class Request(Base):
     user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
     service_name = Column(String, primary_key=True)
     request_count = Column(Integer)
+
+
+class UsageRollup(Base):
+    # Requests per UTC day, user and service, kept up to date by every counter flush
+    __tablename__ = "usage_rollups"
+    __table_args__ = (
+        # Covers the top users query, which reads a range of days and groups by user
+        Index("usage_rollups_day_user", "day", "user_id", "request_count"),
+    )
+
+    day = Column(String, primary_key=True)
+    service_name = Column(String, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    request_count = Column(Integer, nullable=False)
+
+
+class ServiceUsageDaily(Base):
+    # Requests per UTC day and service, a few rows per day however many users there are
+    __tablename__ = "service_usage_daily"
+
+    day = Column(String, primary_key=True)
+    service_name = Column(String, primary_key=True)
+    request_count = Column(Integer, nullable=False)
@@ -0,0 +1,89 @@
+import asyncio
+import io
+from typing import Optional
+
+# Containers the Whisper API accepts as they are
+WHISPER_FORMATS = {"flac", "m4a", "mp3", "mp4", "mpeg", "mpga", "oga", "ogg", "wav", "webm"}
+
+MIME_FORMATS = {
+    "audio/ogg": "ogg",
+    "audio/opus": "ogg",
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/mp4": "m4a",
+    "audio/m4a": "m4a",
+    "audio/x-m4a": "m4a",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/webm": "webm",
+    "audio/flac": "flac",
+    "audio/x-flac": "flac",
+    "video/mp4": "mp4",
+}
+
+
+def audio_format(attachment) -> Optional[str]:
+    file_name = getattr(attachment, "file_name", None)
+    if file_name and "." in file_name:
+        return file_name.rsplit(".", 1)[1].lower()
+
+    mime_type = getattr(attachment, "mime_type", None)
+    if mime_type:
+        return MIME_FORMATS.get(mime_type.lower(), mime_type.split("/")[-1].lower())
+    return None
+
+
+def transcode_to_mp3(data: bytes, source_format: Optional[str] = None) -> bytes:
+    from pydub import AudioSegment
+
+    audio_track = AudioSegment.from_file(io.BytesIO(data), format=source_format)
+    output = io.BytesIO()
+    audio_track.export(output, format="mp3")
+    return output.getvalue()
+
+
+async def prepare_for_transcription(data: bytes, attachment) -> tuple[str, bytes]:
+    source_format = audio_format(attachment)
+    if source_format in WHISPER_FORMATS:
+        return f"audio.{source_format}", data
+
+    # Decoding and encoding are CPU bound, keep them off the event loop
+    data = await asyncio.to_thread(transcode_to_mp3, data, source_format)
+    return "audio.mp3", data
+
+
+def split_on_silence_bounded(data: bytes, source_format: Optional[str] = None, max_segment_ms: int = 300_000,
+                             search_window_ms: int = 30_000, min_silence_ms: int = 500,
+                             silence_offset_db: float = 16) -> list[bytes]:
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+
+    audio = AudioSegment.from_file(io.BytesIO(data), format=source_format).set_channels(1)
+    silence_threshold = audio.dBFS - silence_offset_db
+    segments = []
+    start = 0
+
+    while len(audio) - start > max_segment_ms:
+        # Cut in the middle of the longest pause near the end of the segment, or hard cut if there is none
+        # The window never reaches back before the segment start, even for segments shorter than it
+        window_start = max(start, start + max_segment_ms - search_window_ms)
+        silences = detect_silence(audio[window_start:start + max_segment_ms], min_silence_len=min_silence_ms,
+                                  silence_thresh=silence_threshold)
+        cut = start + max_segment_ms
+        if silences:
+            silence_start, silence_end = max(silences, key=lambda silence: silence[1] - silence[0])
+            cut = window_start + (silence_start + silence_end) // 2
+        # A pause right at the window start would give an empty segment and never advance
+        if cut <= start:
+            cut = start + max_segment_ms
+        segments.append(audio[start:cut])
+        start = cut
+    segments.append(audio[start:])
+
+    # 64 kbit/s mono keeps a five minute segment around 2.4 MB, far below Whisper's upload limit
+    exported = []
+    for segment in segments:
+        output = io.BytesIO()
+        segment.export(output, format="mp3", bitrate="64k")
+        exported.append(output.getvalue())
+    return exported
@@ -0,0 +1,94 @@
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from cachetools import TTLCache
+
+from utils.token_counter import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# (role, text) pairs, role is "user", "assistant" or "system" for the summary of older turns
+Turn = tuple[str, str]
+
+
+class Conversation:
+    __slots__ = ("turns", "summary")
+
+    def __init__(self, max_turns: int):
+        self.turns: deque[Turn] = deque(maxlen=max_turns)
+        self.summary: Optional[str] = None
+
+
+class ConversationMemory:
+    def __init__(self, max_turns: int = 20, token_budget: int = 3000, max_sessions: int = 10000,
+                 idle_ttl: float = 1800, max_turn_chars: int = 8000,
+                 summarizer: Optional[Callable[[int, str], Awaitable[str]]] = None):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.max_turn_chars = max_turn_chars
+        # Called with the user id and the transcript of the older turns, returns their summary
+        self.summarizer = summarizer
+        # Sessions are keyed by (user_id, service) and dropped after idle_ttl seconds without a new message
+        self.sessions = TTLCache(maxsize=max_sessions, ttl=idle_ttl)
+
+    def history(self, user_id: int, service: str) -> list[Turn]:
+        conversation = self.sessions.get((user_id, service))
+        if conversation is None:
+            return []
+
+        # Keep the newest turns that fit the token budget, the summary goes first when there is room left
+        budget = self.token_budget
+        history = []
+        for role, text in reversed(conversation.turns):
+            budget -= count_tokens(text, service)
+            if budget < 0:
+                break
+            history.append((role, text))
+        history.reverse()
+        # Gemini expects the history to start with a user turn
+        if history and history[0][0] == "assistant":
+            history.pop(0)
+
+        if conversation.summary and count_tokens(conversation.summary, service) <= budget:
+            history.insert(0, ("system", f"Summary of the earlier conversation: {conversation.summary}"))
+        return history
+
+    async def add_exchange(self, user_id: int, service: str, user_text: str, assistant_text: str) -> None:
+        key = (user_id, service)
+        conversation = self.sessions.get(key) or Conversation(self.max_turns)
+
+        if self.summarizer is not None and len(conversation.turns) + 2 > self.max_turns:
+            await self._summarize(user_id, conversation)
+
+        conversation.turns.append(("user", user_text[:self.max_turn_chars]))
+        conversation.turns.append(("assistant", assistant_text[:self.max_turn_chars]))
+        # Storing the session again renews its idle timeout
+        self.sessions[key] = conversation
+
+    async def _summarize(self, user_id: int, conversation: Conversation) -> None:
+        half = len(conversation.turns) // 2
+        older = [conversation.turns.popleft() for _ in range(half)]
+        transcript = "\n".join(f"{role}: {text}" for role, text in older)
+        if conversation.summary:
+            transcript = f"Earlier summary: {conversation.summary}\n{transcript}"
+
+        try:
+            conversation.summary = await self.summarizer(user_id, transcript)
+        except Exception:
+            logger.exception("Failed to summarize conversation, older turns are dropped")
+
+    def reset(self, user_id: int) -> None:
+        for key in [key for key in self.sessions if key[0] == user_id]:
+            del self.sessions[key]
+
+    def stats(self) -> dict:
+        conversations = list(self.sessions.values())
+        return {
+            "sessions": len(conversations),
+            "turns": sum(len(conversation.turns) for conversation in conversations),
+            "text_bytes": sum(
+                len(text.encode("utf-8")) for conversation in conversations for _, text in conversation.turns
+            ) + sum(len(conversation.summary.encode("utf-8")) for conversation in conversations
+                    if conversation.summary),
+        }
@@ -0,0 +1,28 @@
+import importlib.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def http2_supported(service: str) -> bool:
+    # httpx only speaks HTTP/2 with the optional h2 package installed (pip install "httpx[http2]")
+    if importlib.util.find_spec("h2") is None:
+        logger.warning(f"HTTP/2 requested for {service} but the h2 package is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def pool_usage(client) -> dict:
+    # httpx keeps its connections in the httpcore pool behind the default transport. These are private
+    # attributes, so anything unexpected (another transport, a changed layout) reports nothing at all.
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if not isinstance(connections, list):
+        return {}
+
+    idle = sum(1 for connection in connections if getattr(connection, "is_idle", lambda: False)())
+    usage = {"active": len(connections) - idle, "idle": idle}
+    limit = getattr(pool, "_max_connections", None)
+    if isinstance(limit, int):
+        usage["limit"] = limit
+    return usage
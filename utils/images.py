@@ -0,0 +1,17 @@
+import io
+
+
+def downscale_image(content: bytes, max_side: int) -> bytes:
+    # Pillow is optional, without it images are sent as they are
+    try:
+        from PIL import Image
+    except ImportError:
+        return content
+
+    with Image.open(io.BytesIO(content)) as image:
+        if max(image.size) <= max_side:
+            return content
+        image.thumbnail((max_side, max_side))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=90)
+        return output.getvalue()
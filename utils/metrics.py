@@ -0,0 +1,195 @@
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from utils.tracing import span
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in key) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        # Per label set: bucket counts (the last one is +Inf), sum and count
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket", key + (("le", le),), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], dict]):
+        # callback returns a mapping of label dicts, as tuples of (name, value) pairs, to the current value
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def samples(self):
+        for key, value in self.callback().items():
+            yield self.name, key, value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, documentation, buckets))
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], dict]) -> Gauge:
+        self.metrics[name] = Gauge(name, documentation, callback)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+update_requests = registry.counter("bot_updates_total", "Updates dispatched to a service")
+update_errors = registry.counter("bot_update_errors_total", "Updates whose service handler raised")
+update_seconds = registry.histogram("bot_update_seconds", "Time to handle an update end to end")
+stage_seconds = registry.histogram("bot_stage_seconds", "Time spent in download, transcode and reply stages")
+provider_requests = registry.counter("provider_requests_total", "Calls made to AI providers")
+provider_errors = registry.counter("provider_errors_total", "Calls to AI providers that failed")
+provider_seconds = registry.histogram("provider_seconds", "AI provider call latency")
+provider_first_token_seconds = registry.histogram("provider_first_token_seconds",
+                                                  "Time until a streaming AI provider call yields its first chunk")
+db_requests = registry.counter("db_operations_total", "Storage operations")
+db_errors = registry.counter("db_errors_total", "Storage operations that failed")
+db_seconds = registry.histogram("db_seconds", "Storage operation latency")
+cache_requests = registry.counter("cache_requests_total", "Cache lookups by cache and result")
+
+
+def instrument(requests: Counter, errors: Counter, seconds: Histogram, first_item: Optional[Histogram] = None,
+               **labels):
+    # Works for coroutine functions and async generators, for generators the whole iteration is timed
+    span_name = ".".join(str(value) for value in labels.values())
+
+    def decorator(function):
+        if inspect.isasyncgenfunction(function):
+            @functools.wraps(function)
+            async def generator_wrapper(*args, **kwargs):
+                requests.inc(**labels)
+                started = time.perf_counter()
+                first = True
+                try:
+                    with span(span_name):
+                        async for item in function(*args, **kwargs):
+                            if first and first_item is not None:
+                                first_item.observe(time.perf_counter() - started, **labels)
+                            first = False
+                            yield item
+                except Exception:
+                    errors.inc(**labels)
+                    raise
+                finally:
+                    seconds.observe(time.perf_counter() - started, **labels)
+
+            return generator_wrapper
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            requests.inc(**labels)
+            started = time.perf_counter()
+            try:
+                with span(span_name):
+                    return await function(*args, **kwargs)
+            except Exception:
+                errors.inc(**labels)
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def stage(name: str):
+    # Times a processing stage both in the stage histogram and as a span of the current trace
+    with span(name), stage_seconds.time(stage=name):
+        yield
+
+
+def provider_call(provider: str, operation: str):
+    return instrument(provider_requests, provider_errors, provider_seconds, provider_first_token_seconds,
+                      provider=provider, operation=operation)
+
+
+def db_operation(backend: str, operation: str):
+    return instrument(db_requests, db_errors, db_seconds, backend=backend, operation=operation)
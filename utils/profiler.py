@@ -0,0 +1,56 @@
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lock = asyncio.Lock()
+
+    async def profile(self, seconds: float, limit: int = 15) -> str:
+        # Samples the stack of the event loop thread from a helper thread, so slow handlers show up as they run
+        async with self.lock:
+            thread_id = threading.get_ident()
+            stop_event = threading.Event()
+            own_samples = Counter()
+            total_samples = Counter()
+            sampler = threading.Thread(
+                target=self._sample, args=(thread_id, stop_event, own_samples, total_samples), daemon=True
+            )
+            sampler.start()
+            await asyncio.sleep(seconds)
+            stop_event.set()
+            await asyncio.to_thread(sampler.join)
+
+        samples = sum(own_samples.values())
+        if not samples:
+            return "No samples were collected."
+
+        lines = [f"{samples} samples over {seconds:g} s, top functions by own time (total time in brackets):"]
+        for function, count in own_samples.most_common(limit):
+            lines.append(f"{count * 100 / samples:5.1f}% ({total_samples[function] * 100 / samples:5.1f}%) {function}")
+        return "\n".join(lines)
+
+    def _sample(self, thread_id: int, stop_event: threading.Event, own_samples: Counter,
+                total_samples: Counter) -> None:
+        while not stop_event.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+
+            own_samples[self._describe(frame)] += 1
+            seen = set()
+            while frame is not None:
+                function = self._describe(frame)
+                if function not in seen:
+                    seen.add(function)
+                    total_samples[function] += 1
+                frame = frame.f_back
+
+    @staticmethod
+    def _describe(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
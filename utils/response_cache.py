@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Optional
+
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class _LeaderCancelled(Exception):
+    """Set on an in-flight future whose computing request was cancelled, its waiters start over."""
+
+
+class ResponseCache:
+    def __init__(self, services: dict[str, float], maxsize: int = 1000, path: Optional[str] = None):
+        # Maps service name to the time to live of its cached responses in seconds
+        self.services = services
+        self.entries = LRUCache(maxsize=maxsize)
+        self.in_flight: dict[str, asyncio.Future] = {}
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.saved_seconds = 0.0
+
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, latency REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self.connection.commit()
+
+    def enabled_for(self, service: str) -> bool:
+        return service in self.services
+
+    @staticmethod
+    def make_key(service: str, prompt: str) -> str:
+        normalized = " ".join(prompt.casefold().split())
+        return hashlib.sha256(f"{service}\0{normalized}".encode()).hexdigest()
+
+    async def get_or_compute(self, service: str, prompt: str, compute: Callable[[], Awaitable[str]]) -> str:
+        key = self.make_key(service, prompt)
+
+        entry = await self._get(key)
+        if entry is not None:
+            value, latency = entry
+            self.hits += 1
+            self.saved_seconds += latency
+            return value
+
+        # Single flight: identical concurrent requests wait for the call that is already running
+        if key in self.in_flight:
+            try:
+                value, latency = await asyncio.shield(self.in_flight[key])
+            except _LeaderCancelled:
+                # The first waiter to get here becomes the new leader, the others wait for it
+                return await self.get_or_compute(service, prompt, compute)
+            self.coalesced += 1
+            self.saved_seconds += latency
+            return value
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        started = time.monotonic()
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            # Cancelling the future would cancel every waiter too, one of them takes over instead
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting for it
+            future.exception()
+            raise
+        finally:
+            self.in_flight.pop(key, None)
+
+        latency = time.monotonic() - started
+        future.set_result((value, latency))
+        await self._set(key, value, latency, self.services[service])
+        return value
+
+    async def _get(self, key: str) -> Optional[tuple[str, float]]:
+        entry = self.entries.get(key)
+        if entry is None and self.connection is not None:
+            entry = await asyncio.to_thread(self._read_from_disk, key)
+            if entry is not None:
+                self.entries[key] = entry
+
+        if entry is None:
+            return None
+
+        value, latency, expires_at = entry
+        if expires_at < time.time():
+            self.entries.pop(key, None)
+            return None
+        return value, latency
+
+    async def _set(self, key: str, value: str, latency: float, ttl: float) -> None:
+        entry = (value, latency, time.time() + ttl)
+        self.entries[key] = entry
+        if self.connection is not None:
+            try:
+                await asyncio.to_thread(self._write_to_disk, key, entry)
+            except sqlite3.Error:
+                logger.exception("Failed to persist cached response")
+
+    def _read_from_disk(self, key: str):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT value, latency, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _write_to_disk(self, key: str, entry: tuple[str, float, float]) -> None:
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, latency, expires_at) VALUES (?, ?, ?, ?)",
+                (key, *entry),
+            )
+            self.connection.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+            self.connection.commit()
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+            "size": len(self.entries),
+        }
@@ -0,0 +1,197 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+from utils.metrics import registry
+from utils.tracing import span
+
+scheduler_wait_seconds = registry.histogram("scheduler_wait_seconds", "Time requests wait for a provider slot")
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # A single request larger than the bucket is let through once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class Waiter:
+    def __init__(self, future: asyncio.Future, tokens: int):
+        self.future = future
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+
+
+class ProviderScheduler:
+    def __init__(self, name: str, max_concurrency: int = 8, max_per_user: int = 2,
+                 requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # Users with waiting requests in round-robin order, each with their own FIFO queue
+        self.queues: OrderedDict[int, deque[Waiter]] = OrderedDict()
+        self.active = 0
+        self.active_per_user: dict[int, int] = {}
+        self.timer = None
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, tokens: int = 0,
+                   on_queued: Optional[Callable[[int], Awaitable[None]]] = None):
+        waiter = Waiter(asyncio.get_running_loop().create_future(), tokens)
+        self.queues.setdefault(user_id, deque()).append(waiter)
+        self._dispatch()
+
+        try:
+            with span(f"queue.{self.name}"):
+                if not waiter.future.done() and on_queued is not None:
+                    await on_queued(self.position(user_id, waiter))
+                await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(user_id)
+            else:
+                waiter.future.cancel()
+                self._remove(user_id, waiter)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    def position(self, user_id: int, waiter: Waiter) -> int:
+        queue = self.queues.get(user_id)
+        if not queue or waiter not in queue:
+            return 0
+
+        # Round robin serves one request per user per turn, so count what is served before this waiter
+        index = queue.index(waiter)
+        position = index + 1
+        before = True
+        for other_user_id, other_queue in self.queues.items():
+            if other_user_id == user_id:
+                before = False
+                continue
+            position += min(len(other_queue), index + 1 if before else index)
+        return position
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queue_depth": self.queue_depth(),
+            "granted": self.granted,
+            "average_wait": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrency:
+            entry = self._next_waiter()
+            if entry is None:
+                return
+
+            user_id, waiter = entry
+            wait = max(
+                self.request_bucket.wait_time(1) if self.request_bucket else 0.0,
+                self.token_bucket.wait_time(waiter.tokens) if self.token_bucket and waiter.tokens else 0.0,
+            )
+            if wait > 0:
+                if self.timer is None:
+                    self.timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+                return
+
+            self._grant(user_id, waiter)
+
+    def _next_waiter(self) -> Optional[tuple[int, Waiter]]:
+        for user_id, queue in list(self.queues.items()):
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if not queue:
+                del self.queues[user_id]
+                continue
+            if self.active_per_user.get(user_id, 0) < self.max_per_user:
+                return user_id, queue[0]
+        return None
+
+    def _grant(self, user_id: int, waiter: Waiter) -> None:
+        # Move the user to the back of the round-robin order
+        queue = self.queues.pop(user_id)
+        queue.popleft()
+        if queue:
+            self.queues[user_id] = queue
+
+        if self.request_bucket:
+            self.request_bucket.consume(1)
+        if self.token_bucket and waiter.tokens:
+            self.token_bucket.consume(waiter.tokens)
+
+        self.active += 1
+        self.active_per_user[user_id] = self.active_per_user.get(user_id, 0) + 1
+        wait = time.monotonic() - waiter.enqueued_at
+        self.granted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        scheduler_wait_seconds.observe(wait, provider=self.name)
+        waiter.future.set_result(None)
+
+    def _release(self, user_id: int) -> None:
+        self.active -= 1
+        self.active_per_user[user_id] -= 1
+        if not self.active_per_user[user_id]:
+            del self.active_per_user[user_id]
+        self._dispatch()
+
+    def _remove(self, user_id: int, waiter: Waiter) -> None:
+        queue = self.queues.get(user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[user_id]
+        self._dispatch()
+
+    def _on_timer(self) -> None:
+        self.timer = None
+        self._dispatch()
+
+
+class Scheduler:
+    def __init__(self, limits: dict[str, dict]):
+        # Maps provider name to ProviderScheduler keyword arguments
+        self.providers = {name: ProviderScheduler(name, **options) for name, options in limits.items()}
+
+    def slot(self, provider: str, user_id: int, tokens: int = 0,
+             on_queued: Optional[Callable[[int], Awaitable[None]]] = None):
+        if provider not in self.providers:
+            self.providers[provider] = ProviderScheduler(provider)
+        return self.providers[provider].slot(user_id, tokens, on_queued)
+
+    def stats(self) -> dict:
+        return {name: provider.stats() for name, provider in self.providers.items()}
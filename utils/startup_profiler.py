@@ -0,0 +1,45 @@
+import builtins
+import sys
+import time
+
+
+class ImportProfiler:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.timings = {}
+        self.depth = 0
+        self._original_import = None
+        self.started = None
+        self.total = 0.0
+
+    def __enter__(self):
+        if self.enabled:
+            self.started = time.perf_counter()
+            self._original_import = builtins.__import__
+            builtins.__import__ = self._import
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            builtins.__import__ = self._original_import
+            self.total += time.perf_counter() - self.started
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        self.depth += 1
+        started = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            self.depth -= 1
+            # Inclusive time, nested imports are counted in their parent as well
+            self.timings.setdefault(name, (time.perf_counter() - started, self.depth))
+
+    def report(self, limit: int = 25) -> str:
+        rows = sorted(self.timings.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        lines = [f"Startup import times (inclusive), {self.total * 1000:.1f} ms profiled in total:"]
+        for name, (seconds, depth) in rows:
+            lines.append(f"{seconds * 1000:10.1f} ms  {'  ' * depth}{name}")
+        return "\n".join(lines)
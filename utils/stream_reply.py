@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterator
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+from utils.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> tuple[str, str]:
+    if len(text) <= limit:
+        return text, ""
+
+    # Prefer to break on a paragraph, line or word boundary in the second half of the message
+    for separator in ("\n\n", "\n", " "):
+        index = text.rfind(separator, limit // 2, limit)
+        if index != -1:
+            return text[:index], text[index:].lstrip()
+
+    return text[:limit], text[limit:]
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    parts = []
+    while text:
+        head, text = split_text(text, limit)
+        parts.append(head)
+    return parts
+
+
+async def send_long_text(message: Message, text: str) -> None:
+    with stage("reply_send"):
+        for part in split_message(text):
+            await message.reply_text(part)
+
+
+class StreamingReply:
+    def __init__(self, message: Message, placeholder: str, edit_interval: float = 1.0,
+                 limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.message = message
+        self.placeholder = placeholder
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.current = None
+        self.shown_text = ""
+        self.last_edit = 0.0
+
+    async def send(self, chunks: AsyncIterator[str]) -> str:
+        self.current = await self.message.reply_text(self.placeholder)
+        self.last_edit = time.monotonic()
+        full_text = []
+        buffer = ""
+
+        try:
+            async for chunk in chunks:
+                full_text.append(chunk)
+                buffer += chunk
+
+                while len(buffer) > self.limit:
+                    head, buffer = split_text(buffer, self.limit)
+                    await self._edit(head, force=True)
+                    # The next message is only sent once there is text for it, see _edit
+                    self.current = None
+
+                await self._edit(buffer)
+        except Exception:
+            logger.exception("Streaming reply failed")
+            error_text = "Something went wrong. We are working on it!"
+            if buffer:
+                error_text = buffer[:self.limit - len(error_text) - 2] + "\n\n" + error_text
+            await self._edit(error_text, force=True)
+            raise
+
+        if not "".join(full_text).strip():
+            buffer = "No response was generated, please try again."
+        await self._edit(buffer, force=True)
+        return "".join(full_text)
+
+    async def _edit(self, text: str, force: bool = False) -> None:
+        if not text.strip() or text == self.shown_text:
+            return
+        if self.current is None:
+            self.current = await self.message.reply_text(text)
+            self.shown_text = text
+            self.last_edit = time.monotonic()
+            return
+        # Coalesce chunks so a message is edited at most once per interval
+        if not force and time.monotonic() - self.last_edit < self.edit_interval:
+            return
+
+        try:
+            await self.current.edit_text(text)
+        except RetryAfter as e:
+            if not force:
+                self.last_edit = time.monotonic() + e.retry_after
+                return
+            await asyncio.sleep(e.retry_after)
+            await self.current.edit_text(text)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self.shown_text = text
+        self.last_edit = time.monotonic()
@@ -1,14 +1,128 @@
-import nltk
-from nltk.tokenize import word_tokenize
+import asyncio
+import logging
+import math
+import threading
+from typing import Optional, Protocol
 
-nltk.download("punkt")
+logger = logging.getLogger(__name__)
 
+DEFAULT_TOKEN_BUDGET = 2048
 
-def validate_user_input(user_input, max_tokens=2048) -> bool:
-    tokens = word_tokenize(user_input)
-    token_count = len(tokens)
+SERVICE_TOKEN_BUDGETS = {
+    "gpt": 4096,
+    "gemini": 4096,
+    "fast": 4096,
+    "tts": 1024,
+    "dalle": 1000,
+}
 
-    if token_count > max_tokens or token_count <= 0:
+# OpenAI caps speech input at 4096 characters and DALL-E 3 prompts at 4000 characters, whatever the token count
+SERVICE_CHARACTER_LIMITS = {
+    "tts": 4096,
+    "dalle": 4000,
+}
+
+# Inputs longer than this many characters per allowed token are rejected without tokenizing
+MAX_CHARS_PER_TOKEN = 10
+
+
+class TokenCounter(Protocol):
+    def count(self, text: str) -> int:
+        ...
+
+
+class HeuristicTokenCounter:
+    def __init__(self, chars_per_token: float = 4.0):
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+
+class TiktokenCounter:
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._fallback = HeuristicTokenCounter()
+
+    def count(self, text: str) -> int:
+        # Loading may download the vocabulary, so it never happens here on the event loop. Until
+        # load_token_counters has finished, or when it failed, the length based estimate is used.
+        if self._encoding is None:
+            return self._fallback.count(text)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def load(self) -> None:
+        # tiktoken keeps the vocabulary in TIKTOKEN_CACHE_DIR, so once it is cached no network is needed
+        import tiktoken
+
+        self._encoding = tiktoken.get_encoding(self.encoding_name)
+
+
+_openai_counter = TiktokenCounter()
+
+token_counters: dict[str, TokenCounter] = {
+    "gpt": _openai_counter,
+    "tts": _openai_counter,
+    "dalle": _openai_counter,
+    "gemini": HeuristicTokenCounter(),
+}
+
+
+async def load_token_counters(timeout: float = 10.0) -> None:
+    # Runs the blocking vocabulary loads at startup, the bot keeps estimating if they fail or hang
+    loop = asyncio.get_running_loop()
+    counters = {counter for counter in token_counters.values() if isinstance(counter, TiktokenCounter)}
+
+    def settle(loaded: asyncio.Future, error: Optional[BaseException]) -> None:
+        if not loaded.done():
+            loaded.set_exception(error) if error else loaded.set_result(None)
+
+    for counter in counters:
+        loaded = loop.create_future()
+
+        # The future is bound per thread, a load that finishes after its timeout only settles its own
+        def load(counter=counter, loaded=loaded) -> None:
+            error = None
+            try:
+                counter.load()
+            except Exception as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(settle, loaded, error)
+            except RuntimeError:
+                pass
+
+        # A daemon thread, so a download that never returns cannot hold up shutdown either
+        threading.Thread(target=load, name="tiktoken-load", daemon=True).start()
+        try:
+            await asyncio.wait_for(loaded, timeout)
+        except Exception as e:
+            logger.warning(f"Could not load {counter.encoding_name} vocabulary, using length based token "
+                           f"estimate: {e!r}")
+
+
+def set_token_counter(service: str, counter: TokenCounter) -> None:
+    token_counters[service] = counter
+
+
+def count_tokens(text: str, service: Optional[str] = None) -> int:
+    return token_counters.get(service, _openai_counter).count(text)
+
+
+def validate_user_input(user_input, max_tokens: Optional[int] = None, service: Optional[str] = None) -> bool:
+    if max_tokens is None:
+        max_tokens = SERVICE_TOKEN_BUDGETS.get(service, DEFAULT_TOKEN_BUDGET)
+
+    if not user_input or not user_input.strip():
+        return False
+    if len(user_input) > SERVICE_CHARACTER_LIMITS.get(service, len(user_input)):
+        return False
+
+    # Every token covers at least one byte, so short inputs always fit the budget
+    if len(user_input.encode("utf-8")) <= max_tokens:
+        return True
+    if len(user_input) > max_tokens * MAX_CHARS_PER_TOKEN:
         return False
 
-    return True
+    return count_tokens(user_input, service) <= max_tokens
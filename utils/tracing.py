@@ -0,0 +1,57 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    __slots__ = ("name", "started", "spans")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        # (span name, start offset, duration, nesting depth)
+        self.spans: list[tuple[str, float, float, int]] = []
+
+    def format(self) -> str:
+        lines = [f"{self.name} took {(time.perf_counter() - self.started) * 1000:.0f} ms"]
+        for name, offset, duration, depth in sorted(self.spans, key=lambda span: span[1]):
+            lines.append(f"  {'  ' * depth}{name}: +{offset * 1000:.0f} ms, {duration * 1000:.0f} ms")
+        return "\n".join(lines)
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+current_depth: ContextVar[int] = ContextVar("current_depth", default=0)
+
+
+@contextmanager
+def trace(name: str, slow_threshold: Optional[float] = None):
+    current = Trace(name)
+    token = current_trace.set(current)
+    try:
+        yield current
+    finally:
+        current_trace.reset(token)
+        duration = time.perf_counter() - current.started
+        if slow_threshold is not None and duration > slow_threshold:
+            logger.warning(f"Slow update: {current.format()}")
+
+
+@contextmanager
+def span(name: str):
+    current = current_trace.get()
+    if current is None:
+        yield
+        return
+
+    depth = current_depth.get()
+    token = current_depth.set(depth + 1)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current_depth.reset(token)
+        current.spans.append((name, started - current.started, time.perf_counter() - started, depth))